@@ -0,0 +1,182 @@
+#In-process publish/subscribe bus for instrument readings.
+#Drivers given a bus (e.g. kepco(bus = bus)) publish every reading they take
+#from the instrument, and any number of consumers (loggers, plots, safety
+#checks, network servers) subscribe to them without talking to the
+#instruments themselves.
+#
+#    bus = data_bus.dataBus()
+#    triton = triton_monitor.triton_monitor(IP, port, bus = bus)
+#    temps = bus.subscribe('triton/*temp')
+#    reading = temps.get(timeout = 5) # reading(time, source, quantity, value, unit)
+#
+#Each subscription has its own bounded queue, so a slow consumer only ever
+#loses its own readings, according to its drop policy:
+#    'drop_oldest' : discard the oldest queued reading (default; keeps the latest)
+#    'drop_newest' : discard the new reading
+#    'block'       : make the publisher wait up to block_timeout s, then drop the new reading
+
+import time
+import fnmatch
+import threading
+import traceback
+from collections import deque, namedtuple
+
+reading = namedtuple('reading', ['time', 'source', 'quantity', 'value', 'unit'])
+
+drop_policies = ['drop_oldest', 'drop_newest', 'block']
+
+class subscription:
+
+    def __init__(self, bus, topics, maxsize, policy, block_timeout):
+        if policy not in drop_policies:
+            raise ValueError('policy must be one of ' + str(drop_policies))
+        self.bus = bus
+        # 'source/quantity' patterns, with * and ? wildcards
+        self.topics = [topics] if isinstance(topics, str) else list(topics)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self.closed = False
+        self._queue = deque()
+        self._condition = threading.Condition()
+
+    def __repr__(self):
+        return 'subscription(' + str(self.topics) + ', ' + str(len(self._queue)) + ' queued, ' + str(self.dropped) + ' dropped)'
+
+    def matches(self, source, quantity):
+        topic = source + '/' + quantity
+        return any(fnmatch.fnmatchcase(topic, pattern) for pattern in self.topics)
+
+    def _put(self, item):
+        with self._condition:
+            if len(self._queue) >= self.maxsize:
+                if self.policy == 'drop_oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                elif self.policy == 'block':
+                    deadline = time.time() + self.block_timeout
+                    while (len(self._queue) >= self.maxsize) and not self.closed:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    if len(self._queue) >= self.maxsize:
+                        self.dropped += 1
+                        return
+                else:
+                    self.dropped += 1
+                    return
+            self._queue.append(item)
+            self._condition.notify_all()
+
+    # Next reading, waiting up to timeout s (forever if None); None on timeout or close
+    def get(self, timeout = None):
+        with self._condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while (len(self._queue) == 0) and not self.closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if (remaining is not None) and (remaining <= 0):
+                    return None
+                self._condition.wait(remaining)
+            if len(self._queue) == 0:
+                return None
+            item = self._queue.popleft()
+            self._condition.notify_all()
+            return item
+
+    # Every queued reading, without waiting
+    def get_all(self):
+        with self._condition:
+            items = list(self._queue)
+            self._queue.clear()
+            self._condition.notify_all()
+            return items
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def _close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+# Publishes a driver reading to bus, if the driver was given one, and
+# returns value, so a driver can return data_bus.publish(self.bus, ...)
+def publish(bus, source, quantity, value, unit = '', timestamp = None):
+    if bus is not None:
+        bus.publish(source, quantity, value, unit, timestamp)
+    return value
+
+class dataBus:
+
+    def __init__(self):
+        self._subscriptions = []
+        self._latest = {} # (source, quantity) : reading
+        self._lock = threading.Lock()
+        self.error_list = []
+
+    def __repr__(self):
+        return 'dataBus(' + str(len(self._subscriptions)) + ' subscriptions, ' + str(len(self._latest)) + ' quantities)'
+
+    # Called by drivers for every reading. Never talks to an instrument and,
+    # unless a subscriber uses the 'block' policy, never waits.
+    def publish(self, source, quantity, value, unit = '', timestamp = None):
+        item = reading(time.time() if timestamp is None else timestamp, source, quantity, value, unit)
+        with self._lock:
+            self._latest[(source, quantity)] = item
+            subscriptions = list(self._subscriptions)
+        for sub in subscriptions:
+            if sub.matches(source, quantity):
+                sub._put(item)
+        return item
+
+    def subscribe(self, topics = '*', maxsize = 1000, policy = 'drop_oldest', block_timeout = 1.0):
+        sub = subscription(self, topics, maxsize, policy, block_timeout)
+        with self._lock:
+            self._subscriptions.append(sub)
+        return sub
+
+    # Calls callback(reading) from its own thread for every matching reading,
+    # so a slow callback never holds up a driver. Returns the subscription;
+    # close() it to stop the thread.
+    def subscribe_callback(self, callback, topics = '*', maxsize = 1000, policy = 'drop_oldest', block_timeout = 1.0):
+        sub = self.subscribe(topics, maxsize, policy, block_timeout)
+        def run():
+            for item in sub:
+                try:
+                    callback(item)
+                except Exception:
+                    err = traceback.format_exc()
+                    print(err)
+                    self.error_list.append(err)
+                    while len(self.error_list) > 20:
+                        self.error_list.pop(0)
+        worker = threading.Thread(target = run)
+        worker.daemon = True
+        worker.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub in self._subscriptions:
+                self._subscriptions.remove(sub)
+        sub._close()
+
+    # Most recent reading of one quantity (None if never published), or a
+    # dictionary (source, quantity) : reading of every quantity matching topics
+    def latest(self, source = None, quantity = None, topics = '*'):
+        with self._lock:
+            if (source is not None) and (quantity is not None):
+                return self._latest.get((source, quantity))
+            items = dict(self._latest)
+        patterns = [topics] if isinstance(topics, str) else list(topics)
+        return dict((key, item) for key, item in items.items()
+                    if any(fnmatch.fnmatchcase(key[0] + '/' + key[1], pattern) for pattern in patterns))
@@ -5,9 +5,16 @@
 import serial
 import time
 
+try:
+    from . import data_bus
+except ImportError: # Imported as a plain module rather than from the package
+    import data_bus
+
 class delta_es150:
 
-    def __init__(self, com_port ='COM6', channel = 1):
+    def __init__(self, com_port ='COM6', channel = 1, bus = None):
+        self.bus = bus # Optional data_bus.dataBus
+        self.bus_source = 'delta_es150'
         self.instr = serial.Serial(com_port, 9600, timeout = 1)
         self.write('CH 1\n')
         self.absolute_voltage_limit = self.read('SO:VO:MAX?\n')
@@ -44,18 +51,18 @@ class delta_es150:
     def measure_voltage(self):
         value = self.read('ME:VO?\n')
         time.sleep(0.01)
-        return value
+        return data_bus.publish(self.bus, self.bus_source, 'voltage', value, 'V')
 
     def measure_current(self):
         value = self.read('ME:CU?\n')
         time.sleep(0.01)
-        return value
+        return data_bus.publish(self.bus, self.bus_source, 'current', value, 'A')
 
     def read_voltage_setpoint(self):
-        return self.read('SO:VO?\n')
+        return data_bus.publish(self.bus, self.bus_source, 'voltage_setpoint', self.read('SO:VO?\n'), 'V')
 
     def read_current_setpoint(self):
-        return self.read('SO:CU?\n')
+        return data_bus.publish(self.bus, self.bus_source, 'current_setpoint', self.read('SO:CU?\n'), 'A')
 
     #TODO: Sanitize inputs
     def set_voltage(self, num):
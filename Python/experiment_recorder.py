@@ -0,0 +1,238 @@
+#Records instrument readings from the whole experiment into one HDF5 timeline.
+#
+#    rec = experiment_recorder.experimentRecorder('run.h5', interval = 1.0)
+#    rec.add_channel('gate_voltage', gate.read_voltage, 'V')
+#    rec.add_channel('magnet/Z_field', lambda: magnet.read_field('Z'), 'T')
+#    rec.add_channel('lockin/sensitivity', lockin.get_sensitivity_volts, 'V')
+#    rec.record_bus(bus, 'triton/*') # everything the triton monitor already reads
+#    rec.start()
+#    ...
+#    rec.stop()
+#
+#Channels added with add_channel are read every interval seconds; readings
+#published to a data_bus.dataBus are recorded as they arrive, with no extra
+#instrument traffic. Each channel is an append-only group timeline/<channel>
+#with chunked, resizable 'time' (unix time) and 'value' datasets and a 'unit'
+#attribute. Only the recorder's writer thread touches the file, and it writes
+#buffered readings every flush_interval seconds.
+#
+#loadTimeline reads channels back, and alignTimeline resamples them onto
+#common times, e.g. to line up temperature and field with a spectroscopy grid.
+
+import sys
+import time
+import threading
+import traceback
+import warnings
+import numpy as np
+with warnings.catch_warnings():
+    warnings.filterwarnings('ignore', category = FutureWarning)
+    import h5py
+try:
+    import Queue
+except ModuleNotFoundError:
+    import queue as Queue
+
+if sys.version_info.major == 2:
+    FileInUseError = IOError
+else:
+    FileInUseError = BlockingIOError
+
+chunk_size = 1024
+
+class experimentRecorder:
+
+    def __init__(self, filename, interval = 1.0, flush_interval = 5.0):
+        self.filename = filename
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.channels = {} # name : (function, unit)
+        self.error_list = []
+        self._queue = Queue.Queue()
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._subscriptions = []
+        self._bus_requests = []
+        self.running = False
+
+    def __repr__(self):
+        return 'experimentRecorder(' + self.filename + ', ' + str(len(self.channels)) + ' channels, ' + \
+            str(len(self._bus_requests)) + ' bus subscriptions, ' + ('running' if self.running else 'stopped') + ')'
+
+    # Reads function() every interval seconds into timeline/<name>
+    def add_channel(self, name, function, unit = ''):
+        self.channels[name] = (function, unit)
+
+    def remove_channel(self, name):
+        self.channels.pop(name, None)
+
+    # Records every reading published to bus that matches topics, as
+    # timeline/<source>/<quantity>. Takes effect on the next start().
+    def record_bus(self, bus, topics = '*', maxsize = 10000):
+        self._bus_requests.append((bus, topics, maxsize))
+
+    def start(self):
+        if self.running:
+            print('RECORDER ALREADY RUNNING')
+            return
+        self.running = True
+        self._stop_event.clear()
+        self._threads = [threading.Thread(target = self._write)]
+        self._threads.append(threading.Thread(target = self._sample))
+        for bus, topics, maxsize in self._bus_requests:
+            sub = bus.subscribe(topics, maxsize)
+            self._subscriptions.append(sub)
+            self._threads.append(threading.Thread(target = self._forward, args = (sub,)))
+        for worker in self._threads:
+            worker.start()
+
+    # Stops sampling, writes out everything still buffered and closes the file
+    def stop(self):
+        if not self.running:
+            return
+        self._stop_event.set()
+        for sub in self._subscriptions:
+            sub.close()
+        for worker in self._threads[1:]:
+            worker.join()
+        self._queue.put(None)
+        self._threads[0].join()
+        self._subscriptions = []
+        self._threads = []
+        self.running = False
+
+    def _log_error(self):
+        err = traceback.format_exc()
+        print(err)
+        self.error_list.append(err)
+        while len(self.error_list) > 20:
+            self.error_list.pop(0)
+
+    def _sample(self):
+        next_time = time.time()
+        while not self._stop_event.is_set():
+            for name, (function, unit) in list(self.channels.items()):
+                try:
+                    value = function()
+                    self._queue.put((name, time.time(), value, unit))
+                except Exception:
+                    self._log_error()
+            next_time += self.interval
+            self._stop_event.wait(max(next_time - time.time(), 0))
+
+    def _forward(self, sub):
+        for item in sub:
+            self._queue.put((item.source + '/' + item.quantity, item.time, item.value, item.unit))
+
+    def _write(self):
+        while True:
+            try:
+                h5file = h5py.File(self.filename, 'a')
+            except FileInUseError:
+                if self._stop_event.wait(0.1):
+                    print('ERROR: ' + self.filename + ' is locked. Buffered readings were not recorded.')
+                    return
+                continue
+            break
+        try:
+            timeline = h5file.require_group('timeline')
+            if 'start_time' not in timeline.attrs:
+                timeline.attrs['start_time'] = time.time()
+            pending = {} # name : (times, values, unit)
+            last_flush = time.time()
+            done = False
+            while not done:
+                try:
+                    item = self._queue.get(timeout = self.flush_interval)
+                except Queue.Empty:
+                    item = False
+                if item is None:
+                    done = True
+                elif item:
+                    name, timestamp, value, unit = item
+                    if name not in pending:
+                        pending[name] = ([], [], unit)
+                    pending[name][0].append(timestamp)
+                    pending[name][1].append(value)
+                if done or (time.time() - last_flush >= self.flush_interval):
+                    for name, (times, values, unit) in pending.items():
+                        try:
+                            self._append(timeline, name, times, values, unit)
+                        except Exception:
+                            self._log_error()
+                    pending = {}
+                    h5file.flush()
+                    last_flush = time.time()
+        finally:
+            h5file.close()
+
+    def _append(self, timeline, name, times, values, unit):
+        if name not in timeline:
+            group = timeline.create_group(name)
+            group.attrs['unit'] = unit
+            group.create_dataset('time', shape = (0,), maxshape = (None,), chunks = (chunk_size,), dtype = np.float64)
+            group.create_dataset('value', shape = (0,), maxshape = (None,), chunks = (chunk_size,), dtype = value_dtype(values[0]))
+        group = timeline[name]
+        values = to_column(values, group['value'].dtype)
+        n = group['time'].shape[0]
+        for dataset, column in [(group['time'], np.asarray(times, dtype = np.float64)), (group['value'], values)]:
+            dataset.resize(n + len(column), axis = 0)
+            dataset[n:] = column
+
+# Numbers (and booleans) are stored as float64, anything else as strings
+def value_dtype(value):
+    try:
+        float(value)
+        return np.float64
+    except (TypeError, ValueError):
+        return h5py.string_dtype()
+
+def to_column(values, dtype):
+    if dtype == np.float64:
+        column = np.empty(len(values), dtype = np.float64)
+        for i, value in enumerate(values):
+            try:
+                column[i] = float(value)
+            except (TypeError, ValueError):
+                column[i] = np.nan
+        return column
+    return np.array([str(value) for value in values], dtype = object)
+
+# Every channel of a recorder file, or just those named in channels, as a
+# dictionary name : (time, value), optionally limited to start <= time <= stop
+def loadTimeline(filename, channels = None, start = None, stop = None):
+    result = {}
+    with h5py.File(filename, 'r') as f:
+        names = []
+        def visit(name, obj):
+            if isinstance(obj, h5py.Group) and ('time' in obj) and ('value' in obj):
+                names.append(name)
+        f['timeline'].visititems(visit)
+        for name in names:
+            if (channels is not None) and (name not in channels):
+                continue
+            group = f['timeline'][name]
+            times = group['time'][()]
+            first = 0 if start is None else np.searchsorted(times, start, 'left')
+            last = len(times) if stop is None else np.searchsorted(times, stop, 'right')
+            values = group['value'][first:last]
+            if values.dtype.kind == 'O':
+                values = np.array([value.decode() if isinstance(value, bytes) else value for value in values], dtype = object)
+            result[name] = (times[first:last], values)
+    return result
+
+# Channels resampled onto times (e.g. the timestamps of a spectroscopy grid):
+# numeric channels are interpolated (NaN outside the recorded range), string
+# channels take the last value recorded at or before each time.
+def alignTimeline(filename, times, channels = None):
+    times = np.asarray(times, dtype = np.float64)
+    aligned = {}
+    for name, (channel_times, values) in loadTimeline(filename, channels).items():
+        if len(channel_times) == 0:
+            aligned[name] = np.full(len(times), np.nan)
+        elif values.dtype.kind == 'O':
+            index = np.searchsorted(channel_times, times, 'right') - 1
+            aligned[name] = np.where(index >= 0, values[np.clip(index, 0, None)], None)
+        else:
+            aligned[name] = np.interp(times, channel_times, values, left = np.nan, right = np.nan)
+    return aligned
@@ -4,39 +4,740 @@ Takes a filename, the header attributes, the data channels, and the numerical da
 and saves this information as a HDF5 file.
 
 Tested in Python 3.6.0 and LabVIEW 2021 (32-bit version).
+
+Run this file (python hdf5.py [port]) to start a writer service; the LabVIEW
+node can then call sendBiasSpectroscopy, which hands the spectrum over and
+returns without waiting for the disk or for a locked file.
 '''
 
 import sys
 import time
+import atexit
+import json
+import socket
+import threading
+import traceback
 import warnings
+import numpy as np
+if sys.version_info.major == 2:
+    import Queue
+else:
+    import queue as Queue
 with warnings.catch_warnings():
     warnings.filterwarnings('ignore', category = FutureWarning)
     import h5py
 
-def saveBiasSpectroscopyasHDF5(filename, attributes, channels, data):
-    if sys.version_info.major == 2:
-        FileInUseError = IOError
-    elif sys.version_info.major == 3:
-        FileInUseError = BlockingIOError
+if sys.version_info.major == 2:
+    FileInUseError = IOError
+elif sys.version_info.major == 3:
+    FileInUseError = BlockingIOError
+
+text_type = type(u'') # What json.loads returns strings as: unicode on Python 2, str on Python 3
+
+layouts = ['datasets', 'stacked']
+
+# Column type of a stacked-layout attribute, from its first value: numbers
+# (or strings that parse as numbers, as LabVIEW sends them) become float64
+# so they can be compared, anything else a variable-length string.
+def attribute_dtype(value):
+    try:
+        float(value)
+        return np.float64
+    except (TypeError, ValueError):
+        return h5py.string_dtype()
+
+# Structured array rows for the attributes of each spectrum. Missing
+# attributes are left as NaN or ''. Attributes that are not a column raise
+# ValueError if strict, and are skipped otherwise.
+def attribute_rows(attributes, dtype, strict = True):
+    rows = np.zeros(len(attributes), dtype = dtype)
+    for name in dtype.names:
+        if dtype[name] == np.float64:
+            rows[name] = np.nan
+        elif dtype[name].kind == 'O':
+            rows[name] = ''
+    for i, attrs in enumerate(attributes):
+        for attr in attrs:
+            name = str(attr[0])
+            if name not in dtype.names:
+                if strict:
+                    raise ValueError("Attribute '" + name + "' is not a column of the stacked layout")
+                continue
+            if dtype[name] == np.float64:
+                try:
+                    rows[name][i] = float(attr[1])
+                except (TypeError, ValueError):
+                    rows[name][i] = np.nan
+            elif dtype[name].kind == 'O':
+                rows[name][i] = str(attr[1])
+    return rows
+
+# The 'datasets' layout keeps an index next to data/: a structured array with
+# the dataset number in column 'index' and one column per attribute of the
+# first spectrum (later attributes that are not columns are left out of the
+# index, but still saved on the dataset). The stacked layout needs none, as
+# stacked/attributes already is one.
+def index_dtype(attributes):
+    columns = [('index', np.int64)]
+    for attr in attributes:
+        name = str(attr[0])
+        if name not in [column[0] for column in columns]:
+            columns.append((name, attribute_dtype(attr[1])))
+    return np.dtype(columns)
+
+# Keeps one spectroscopy file open across calls, so each spectrum costs the
+# same no matter how many are already in the file. The next index is found
+# once when the file is opened and then tracked in memory; the 'index' and
+# 'size' file attributes are brought up to date at most every flush_interval
+# seconds (and on flush/close).
+# With layout = 'datasets' every spectrum is its own dataset data/%09d, as
+# saveBiasSpectroscopyasHDF5 always did. With layout = 'stacked' they are
+# appended to a single stacked/data dataset of shape (N, channels, points),
+# with one row per spectrum in the structured array stacked/attributes, so
+# a whole grid is read back with one slice (see loadStackedSpectroscopy).
+# Every spectrum in a stacked file must then have the same channels, number
+# of points and attribute names. Spectra are numbered from 1 in both layouts:
+# the spectrum in stacked row i is named '%09d' % (i + 1), as data/%09d would be.
+# With swmr = True (stacked layout only, since no new datasets can be made
+# in SWMR mode) the file is switched to single-writer/multiple-reader mode
+# once the stacked datasets exist, and every append is flushed, so
+# followStackedSpectroscopy can read the grid while it is being taken.
+# Readers hold the file open, so a SWMR writer can't be reopened once they
+# attach: it raises FileInUseError instead of waiting for the file, and
+# saveBiasSpectroscopyasHDF5 needs keep_open = True with swmr = True.
+# Other writers wait for a file that is in use, for at most open_timeout
+# seconds if given.
+class biasSpectroscopyWriter:
+    def __init__(self, filename, compression = None, flush_interval = 5.0, layout = 'datasets', swmr = False, open_timeout = None):
+        if layout not in layouts:
+            raise ValueError('layout must be one of ' + str(layouts))
+        if swmr and layout != 'stacked':
+            raise ValueError("SWMR needs layout = 'stacked'")
+        self.filename = filename
+        self.compression = compression
+        self.flush_interval = flush_interval
+        self.layout = layout
+        self.swmr = swmr
+        start = time.time()
+        while True:
+            try:
+                if swmr:
+                    self.file = h5py.File(filename, 'a', libver = 'latest')
+                else:
+                    self.file = h5py.File(filename, 'a')
+            except FileInUseError:
+                if swmr or ((open_timeout is not None) and (time.time() - start > open_timeout)):
+                    raise
+                time.sleep(0.1)
+                continue
+            break
+        if layout == 'stacked':
+            self.stack = self.file['stacked/data'] if 'stacked' in self.file else None
+            self.table = self.file['stacked/attributes'] if 'stacked' in self.file else None
+            if swmr and (self.stack is not None):
+                self.file.swmr_mode = True
+        else:
+            if 'data' not in self.file.keys():
+                self.file.create_group('data')
+                self.file.attrs['index'] = 0
+                self.file.attrs['size'] = 0
+            self.group = self.file['data']
+            self.index = self.file.attrs['index']
+            self.size = len(self.group)
+            # Files written without an index only get one from rebuildSpectroscopyIndex
+            self.index_table = self.file['index'] if 'index' in self.file else None
+            self.keep_index = (self.index_table is not None) or (self.size == 0)
+        self.last_flush = time.time()
+
+    # Raises ValueError unless the writer was opened with these options, so a
+    # cached writer is never silently reused with different ones
+    def check_options(self, compression, flush_interval, layout, swmr):
+        requested = {'compression': compression, 'flush_interval': flush_interval, 'layout': layout, 'swmr': swmr}
+        current = {'compression': self.compression, 'flush_interval': self.flush_interval, 'layout': self.layout, 'swmr': self.swmr}
+        different = [name for name in sorted(requested) if requested[name] != current[name]]
+        if different:
+            raise ValueError(self.filename + ' is already open with ' +
+                             ', '.join(name + ' = ' + repr(current[name]) for name in different) +
+                             '; close it first to change ' + ', '.join(different))
+
+    # Raises ValueError if spectra with these channels and shape (channels,
+    # points) don't fit the stacked layout already in the file
+    def check_spectra(self, channels, shape):
+        if (self.layout != 'stacked') or (self.stack is None):
+            return
+        if tuple(shape) != self.stack.shape[1:]:
+            raise ValueError('Spectra of shape ' + str(tuple(shape)) + ' do not fit the stacked layout ' + str(self.stack.shape[1:]))
+        if '||'.join(channels) != self.stack.attrs['channels']:
+            raise ValueError('Channels ' + str(channels) + ' differ from the stacked layout channels')
+
+    def _next_name(self):
+        dataindex = self.index + 1
+        while ('%09d' % dataindex) in self.group:
+            dataindex += 1
+        return dataindex, '%09d' % dataindex
+
+    # data is one LabVIEW data array, of shape (points, channels)
+    def write(self, attributes, channels, data):
+        return self.ingest(attributes, channels, np.asarray(data).T)
+
+    # Writes several spectra at once; data has shape (spectra, points, channels),
+    # i.e. one LabVIEW data array per spectrum. Returns the name of the first one.
+    def write_many(self, attributes, channels, data):
+        return self.ingest(attributes, channels, np.asarray(data).transpose(0, 2, 1))
+
+    # Writes spectra that are already in the file layout: (channels, points)
+    # for one spectrum, or (spectra, channels, points) with one attribute list
+    # per spectrum. A C-contiguous array, or any buffer NumPy can wrap without
+    # copying, is handed to HDF5 as it is; anything else (e.g. the transposed
+    # arrays from write) is made contiguous once here.
+    def ingest(self, attributes, channels, data):
+        data = np.ascontiguousarray(data)
+        if data.ndim == 2:
+            data = data[np.newaxis]
+            attributes = [attributes]
+        if len(attributes) != len(data):
+            raise ValueError('Got ' + str(len(attributes)) + ' attribute lists for ' + str(len(data)) + ' spectra')
+        if self.layout == 'stacked':
+            return self._append_stack(attributes, channels, data)
+        names = [self._write_dataset(attrs, channels, spectrum) for attrs, spectrum in zip(attributes, data)]
+        return names[0]
+
+    def _write_dataset(self, attributes, channels, data):
+        dataindex, dataname = self._next_name()
+        dataset = self.group.create_dataset(dataname, shape = data.shape, dtype = data.dtype, chunks = True, compression = self.compression)
+        dataset.write_direct(data)
+        attrs = dict((attr[0], attr[1]) for attr in attributes)
+        attrs['channels'] = '||'.join(channels)
+        dataset.attrs.update(attrs)
+        if self.keep_index:
+            self._append_index(dataindex, attributes)
+        self.index = dataindex
+        self.size += 1
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return dataname
+
+    def _append_index(self, dataindex, attributes):
+        if self.index_table is None:
+            self.index_table = self.file.create_dataset('index', shape = (0,), maxshape = (None,), chunks = (256,),
+                                                        dtype = index_dtype(attributes))
+        row = attribute_rows([attributes], self.index_table.dtype, strict = False)
+        row['index'] = dataindex
+        n = self.index_table.shape[0]
+        self.index_table.resize(n + 1, axis = 0)
+        self.index_table[n:] = row
+
+    def _append_stack(self, attributes, channels, data):
+        if self.stack is None:
+            self._create_stack(attributes[0], channels, data)
+        self.check_spectra(channels, data.shape[1:])
+        rows = attribute_rows(attributes, self.table.dtype)
+        row = self.stack.shape[0] # Count from the dataset itself, not a separate counter
+        self.stack.resize(row + len(data), axis = 0)
+        self.stack.write_direct(data, dest_sel = np.s_[row:row + len(data)])
+        self.table.resize(row + len(data), axis = 0)
+        self.table[row:] = rows
+        if self.file.swmr_mode:
+            self.stack.flush()
+            self.table.flush()
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return '%09d' % (row + 1)
+
+    def _create_stack(self, attributes, channels, data):
+        group = self.file.require_group('stacked')
+        shape = data.shape[1:]
+        self.stack = group.create_dataset('data', shape = (0,) + shape, maxshape = (None,) + shape,
+                                          chunks = (1,) + shape, dtype = data.dtype, compression = self.compression)
+        self.stack.attrs['channels'] = '||'.join(channels)
+        dtype = np.dtype([(str(attr[0]), attribute_dtype(attr[1])) for attr in attributes])
+        self.table = group.create_dataset('attributes', shape = (0,), maxshape = (None,), chunks = (256,), dtype = dtype)
+        if self.swmr:
+            self.file.swmr_mode = True
+
+    def flush(self):
+        if self.file.swmr_mode: # Attributes can't be changed in SWMR mode; readers use the dataset shape
+            pass
+        elif self.layout == 'stacked':
+            self.file.attrs['size'] = 0 if self.stack is None else self.stack.shape[0]
+        else:
+            self.file.attrs['size'] = self.size
+            self.file.attrs['index'] = self.index
+        self.file.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+# Writers kept open between LabVIEW calls with keep_open = True, by filename
+_writers = {}
+
+def _write_with(method, filename, attributes, channels, data, keep_open, compression, flush_interval, layout, swmr):
+    if swmr and not keep_open:
+        raise ValueError('SWMR needs keep_open = True')
+    if keep_open:
+        if filename not in _writers:
+            _writers[filename] = biasSpectroscopyWriter(filename, compression, flush_interval, layout, swmr)
+        else:
+            _writers[filename].check_options(compression, flush_interval, layout, swmr)
+        return getattr(_writers[filename], method)(attributes, channels, data)
+    writer = biasSpectroscopyWriter(filename, compression, flush_interval, layout, swmr)
+    try:
+        return getattr(writer, method)(attributes, channels, data)
+    finally:
+        writer.close()
+
+def saveBiasSpectroscopyasHDF5(filename, attributes, channels, data, keep_open = False, compression = None, flush_interval = 5.0, layout = 'datasets', swmr = False):
+    return _write_with('write', filename, attributes, channels, data, keep_open, compression, flush_interval, layout, swmr)
+
+# Like saveBiasSpectroscopyasHDF5, but data is already in the file layout,
+# (channels, points), so it is written without an intermediate copy.
+def ingestBiasSpectroscopyasHDF5(filename, attributes, channels, data, keep_open = False, compression = None, flush_interval = 5.0, layout = 'datasets', swmr = False):
+    return _write_with('ingest', filename, attributes, channels, data, keep_open, compression, flush_interval, layout, swmr)
+
+# Closes the writer kept open for filename, or all of them if no filename is given.
+# Call it at the end of a grid so other programs can open the file.
+def closeBiasSpectroscopyHDF5(filename = None):
+    filenames = list(_writers.keys()) if filename is None else [filename]
+    for name in filenames:
+        writer = _writers.pop(name, None)
+        if writer is not None:
+            writer.close()
+
+atexit.register(closeBiasSpectroscopyHDF5)
+
+# Reads rows (a slice, index array or boolean mask) of a stacked-layout file.
+# Returns (data, attributes, channels) with data of shape (N, channels, points)
+# and attributes the matching rows of the structured attribute table.
+def loadStackedSpectroscopy(filename, rows = slice(None)):
+    with h5py.File(filename, 'r') as f:
+        stack = f['stacked/data']
+        channels = stack.attrs['channels']
+        if isinstance(channels, bytes):
+            channels = channels.decode()
+        return stack[rows], f['stacked/attributes'][rows], channels.split('||')
+
+# Builds the index of a 'datasets' layout file from the attributes of every
+# dataset, replacing any existing one, so files written before the index
+# existed (or by other programs) can be queried. Stacked files need no
+# index. Returns the number of spectra indexed.
+def rebuildSpectroscopyIndex(filename):
+    closeBiasSpectroscopyHDF5(filename)
     while True:
         try:
-            with h5py.File(filename, 'a') as f:
-                if 'data' not in f.keys():
-                    f.create_group('data')
-                    f.attrs['index'] = 0
-                    f.attrs['size'] = 0
-                dataindex = f.attrs['index'] + 1
-                while ('%09d' % dataindex) in f['data'].keys():
-                    dataindex += 1
-                dataname = '%09d' % dataindex
-                f['data'].create_dataset(dataname, data = data.T)
-                for attr in attributes:
-                    f['data'][dataname].attrs[ attr[0] ] = attr[1]
-                f['data'][dataname].attrs['channels'] = '||'.join(channels)
-                f.attrs['size'] = len(f['data'])
-                f.attrs['index'] = dataindex
+            f = h5py.File(filename, 'a')
         except FileInUseError:
             time.sleep(0.1)
             continue
         break
-    return dataname
\ No newline at end of file
+    with f:
+        if 'stacked' in f:
+            return f['stacked/attributes'].shape[0]
+        table = _scan_index(f)
+        if 'index' in f:
+            del f['index']
+        f.create_dataset('index', data = table, maxshape = (None,), chunks = (256,))
+        return len(table)
+
+def _scan_index(f):
+    names = sorted(f['data'].keys()) if 'data' in f else []
+    attributes = []
+    for name in names:
+        attrs = f['data'][name].attrs
+        attributes.append([(key, attrs[key]) for key in attrs.keys() if key != 'channels'])
+    columns = []
+    for attrs in attributes:
+        columns.extend(attr for attr in attrs if attr[0] not in [column[0] for column in columns])
+    table = attribute_rows(attributes, index_dtype(columns), strict = False)
+    table['index'] = [int(name) for name in names]
+    return table
+
+# The index (or stacked attribute table) of a file, as a structured array.
+# A 'datasets' file without an up-to-date index is scanned instead, which is
+# slow for big files; rebuildSpectroscopyIndex saves the result.
+def loadSpectroscopyIndex(filename):
+    with _open_for_query(filename) as f:
+        return _load_index(f)
+
+def _load_index(f):
+    if 'stacked' in f:
+        return f['stacked/attributes'][()]
+    if ('index' in f) and (f['index'].shape[0] == len(f['data'])):
+        return f['index'][()]
+    return _scan_index(f)
+
+class _open_for_query:
+    # Uses the open writer if this process has one for filename, since HDF5
+    # won't open the same file again read-only
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+    def __enter__(self):
+        writer = _writers.get(self.filename)
+        if writer is not None:
+            writer.flush()
+            return writer.file
+        self.file = h5py.File(self.filename, 'r')
+        return self.file
+    def __exit__(self, *args):
+        if self.file is not None:
+            self.file.close()
+
+# Rows of the index matching every condition in conditions, a dict of
+# attribute name to either a (low, high) range, inclusive, with None for an
+# open end, or a single value to match exactly (e.g. a string attribute).
+def _match(table, conditions):
+    mask = np.ones(len(table), dtype = bool)
+    for name, condition in conditions.items():
+        if name not in table.dtype.names:
+            raise KeyError("No indexed attribute '" + name + "'")
+        column = table[name]
+        if column.dtype.kind == 'O':
+            column = np.array([value.decode() if isinstance(value, bytes) else value for value in column], dtype = object)
+        if isinstance(condition, (tuple, list)):
+            low, high = condition
+            if low is not None:
+                mask &= column >= low
+            if high is not None:
+                mask &= column <= high
+        else:
+            mask &= column == condition
+    return mask
+
+# Spectra matching conditions (see _match), e.g.
+#   querySpectroscopy(filename, {'Vg': (2, 3)})
+# for every spectrum with a gate voltage between 2 and 3 V. Returns
+# (data, attributes, names): data of shape (N, channels, points), the matching
+# index rows, and the names of the spectra (numbered from 1 in both layouts).
+def querySpectroscopy(filename, conditions):
+    with _open_for_query(filename) as f:
+        table = _load_index(f)
+        mask = _match(table, conditions)
+        if 'stacked' in f:
+            rows = np.nonzero(mask)[0]
+            data = f['stacked/data'][rows] if len(rows) else np.zeros((0,) + f['stacked/data'].shape[1:])
+            return data, table[rows], ['%09d' % (row + 1) for row in rows]
+        names = ['%09d' % index for index in table['index'][mask]]
+        spectra = [f['data'][name][()] for name in names]
+        if len(set(spectrum.shape for spectrum in spectra)) > 1:
+            raise ValueError('Matching spectra have different shapes; narrow the query')
+        return np.array(spectra), table[mask], names
+
+# Follows a stacked-layout file that a writer with swmr = True is appending
+# to, without blocking it. Yields (data, attributes) for each batch of new
+# rows, starting at row start, checking every poll_interval seconds. Stops
+# after timeout seconds without new rows (None to follow forever).
+# Waits for the writer if the file does not exist or is not in SWMR mode yet.
+def followStackedSpectroscopy(filename, start = 0, poll_interval = 0.5, timeout = None):
+    last_row_time = time.time()
+    f = None
+    try:
+        while f is None:
+            try:
+                f = h5py.File(filename, 'r', libver = 'latest', swmr = True)
+                if 'stacked/attributes' not in f:
+                    f.close()
+                    f = None
+            except (OSError, FileInUseError):
+                f = None
+            if f is None:
+                if (timeout is not None) and (time.time() - last_row_time > timeout):
+                    return
+                time.sleep(poll_interval)
+        stack = f['stacked/data']
+        table = f['stacked/attributes']
+        while True:
+            stack.refresh()
+            table.refresh()
+            end = min(stack.shape[0], table.shape[0])
+            if end > start:
+                yield stack[start:end], table[start:end]
+                start = end
+                last_row_time = time.time()
+            elif (timeout is not None) and (time.time() - last_row_time > timeout):
+                return
+            else:
+                time.sleep(poll_interval)
+    finally:
+        if f is not None:
+            f.close()
+
+writer_port = 65250
+
+def _recv_exactly(conn, nbytes):
+    chunks = []
+    while nbytes > 0:
+        chunk = conn.recv(min(nbytes, 1 << 20))
+        if not chunk:
+            raise EOFError('Connection closed with ' + str(nbytes) + ' bytes missing')
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return b''.join(chunks)
+
+def _recv_line(conn):
+    line = b''
+    while not line.endswith(b'\n'):
+        chunk = conn.recv(1)
+        if not chunk:
+            raise EOFError('Connection closed before the end of the header')
+        line += chunk
+    return line
+
+def _send_request(header, payload = b'', host = '127.0.0.1', port = writer_port, timeout = 5):
+    s = socket.create_connection((host, port), timeout = timeout)
+    try:
+        s.sendall(json.dumps(header, default = str).encode() + b'\n')
+        if payload:
+            s.sendall(payload)
+        reply = _recv_line(s).decode().strip()
+    finally:
+        s.close()
+    if reply.startswith('ERROR'):
+        raise RuntimeError(reply)
+    return reply
+
+# LabVIEW-side replacement for saveBiasSpectroscopyasHDF5 when the writer
+# service is running. Each message is one JSON header line followed by the
+# raw bytes of data; the service replies as soon as the spectrum is queued.
+def sendBiasSpectroscopy(filename, attributes, channels, data, layout = 'datasets', compression = None, swmr = False, host = '127.0.0.1', port = writer_port):
+    data = np.ascontiguousarray(data)
+    header = {'command': 'WRITE', 'filename': filename, 'attributes': [list(attr) for attr in attributes],
+              'channels': list(channels), 'layout': layout, 'compression': compression, 'swmr': swmr,
+              'dtype': data.dtype.str, 'shape': data.shape, 'nbytes': data.nbytes}
+    return _send_request(header, data.tobytes(), host, port)
+
+# Asks the service to write out and close filename (or every file), so it can be opened elsewhere
+def closeRemoteSpectroscopy(filename = None, host = '127.0.0.1', port = writer_port):
+    return _send_request({'command': 'CLOSE', 'filename': filename}, host = host, port = port)
+
+def stopWriterService(host = '127.0.0.1', port = writer_port):
+    return _send_request({'command': 'QUIT'}, host = host, port = port)
+
+# Writer service: a listen thread accepts spectra and queues them, and a
+# single writer thread drains the queue in batches of up to batch_size,
+# appending runs of same-shaped spectra for a stacked file with one
+# write_many. Files stay open between batches (and are flushed whenever the
+# queue goes idle for flush_interval seconds) until CLOSE or QUIT. A file that
+# stays in use elsewhere for open_timeout seconds is skipped and logged.
+# Each WRITE is checked against the writer already open for its file (or the
+# first spectrum queued for it) before the reply, so spectra the writer
+# thread would refuse get ERROR instead of OK.
+class spectroscopyWriterServer:
+    def __init__(self, host = '127.0.0.1', port = writer_port, batch_size = 64, flush_interval = 5.0, open_timeout = 5.0):
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.open_timeout = open_timeout
+        self.queue = Queue.Queue()
+        self.writers = {}
+        self.pending = {} # filename : (options, channels, shape) of the first spectrum queued for a file not open yet
+        self._lock = threading.Lock() # Guards writers and pending between the listen and writer threads
+        self.error_list = []
+        self._running = False
+
+    def serve_forever(self):
+        self._running = True
+        writer = threading.Thread(target = self._write_loop)
+        writer.start()
+        try:
+            self._listen()
+        finally:
+            self._running = False
+            self.queue.put(None)
+            writer.join()
+
+    def _log_error(self):
+        err = traceback.format_exc()
+        print(err)
+        self.error_list.append(err)
+        while len(self.error_list) > 20:
+            self.error_list.pop(0)
+
+    def _listen(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((self.host, self.port))
+        s.listen(5)
+        print('Spectroscopy writer listening on ' + self.host + ':' + str(self.port))
+        try:
+            while self._running:
+                conn, _ = s.accept()
+                try:
+                    header = json.loads(_recv_line(conn).decode())
+                    command = header.get('command', 'WRITE')
+                    if command == 'WRITE':
+                        payload = _recv_exactly(conn, header['nbytes'])
+                        data = np.frombuffer(payload, dtype = header['dtype']).reshape(header['shape'])
+                        self._check_write(header, data)
+                        self.queue.put((header, data))
+                    elif command == 'CLOSE':
+                        with self._lock:
+                            if header.get('filename') is None:
+                                self.pending.clear()
+                            else:
+                                self.pending.pop(header['filename'], None)
+                        self.queue.put((header, None))
+                    elif command == 'QUIT':
+                        self._running = False
+                    else:
+                        raise ValueError('Unknown command ' + str(command))
+                    conn.sendall('OK\n'.encode())
+                except Exception:
+                    self._log_error()
+                    try:
+                        conn.sendall(('ERROR: ' + traceback.format_exc().splitlines()[-1] + '\n').encode())
+                    except socket.error:
+                        pass
+                finally:
+                    conn.close()
+        finally:
+            s.close()
+
+    # Raises ValueError for a WRITE the writer thread could not write, so the
+    # client gets an ERROR reply instead of OK
+    def _check_write(self, header, data):
+        filename = header.get('filename')
+        if not isinstance(filename, text_type) or not filename:
+            raise ValueError('No filename')
+        layout = header.get('layout', 'datasets')
+        if layout not in layouts:
+            raise ValueError('layout must be one of ' + str(layouts))
+        if header.get('swmr', False) and layout != 'stacked':
+            raise ValueError("SWMR needs layout = 'stacked'")
+        if header.get('compression') not in [None, 'gzip', 'lzf'] + list(range(10)):
+            raise ValueError('Unknown compression ' + str(header.get('compression')))
+        channels = header.get('channels')
+        if not isinstance(channels, list) or not channels or not all(isinstance(channel, text_type) for channel in channels):
+            raise ValueError('channels must be a list of names')
+        attributes = header.get('attributes')
+        if not isinstance(attributes, list) or \
+           not all(isinstance(attr, list) and len(attr) == 2 and isinstance(attr[0], text_type) for attr in attributes):
+            raise ValueError('attributes must be a list of [name, value] pairs')
+        if (data.ndim != 2) or (data.shape[1] != len(channels)):
+            raise ValueError('data of shape ' + str(data.shape) + ' does not have ' + str(len(channels)) + ' channels')
+        options = self._options(header)
+        shape = (len(channels), data.shape[0]) # As stored
+        with self._lock:
+            writer = self.writers.get(filename)
+            if writer is not None:
+                writer.check_options(*options)
+                writer.check_spectra(channels, shape)
+            elif filename in self.pending:
+                first_options, first_channels, first_shape = self.pending[filename]
+                if options != first_options:
+                    raise ValueError(filename + ' is already queued with different compression, layout or swmr')
+                if (layout == 'stacked') and ((channels != first_channels) or (shape != first_shape)):
+                    raise ValueError('Spectra of shape ' + str(shape) + ' with channels ' + str(channels) +
+                                     ' do not fit the stacked layout ' + str(first_shape) + ' queued for ' + filename)
+            else:
+                self.pending[filename] = (options, channels, shape)
+
+    def _options(self, header):
+        return (header.get('compression'), self.flush_interval, header.get('layout', 'datasets'), header.get('swmr', False))
+
+    def _write_loop(self):
+        while True:
+            try:
+                item = self.queue.get(timeout = self.flush_interval)
+            except Queue.Empty:
+                with self._lock:
+                    self._flush_all()
+                continue
+            batch = [item]
+            while (item is not None) and (len(batch) < self.batch_size):
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                batch.append(item)
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            try:
+                self._write_batch(batch)
+            except Exception:
+                self._log_error()
+            if stop:
+                with self._lock:
+                    self._close(None)
+                return
+
+    def _write_batch(self, batch):
+        start = 0
+        while start < len(batch):
+            header, data = batch[start]
+            if data is None:
+                with self._lock:
+                    self._close(header['filename'])
+                start += 1
+                continue
+            key = (header['filename'], header['channels'], data.shape)
+            end = start + 1
+            while (end < len(batch)) and (batch[end][1] is not None) and \
+                  ((batch[end][0]['filename'], batch[end][0]['channels'], batch[end][1].shape) == key):
+                end += 1
+            self._write_run(batch[start:end])
+            start = end
+
+    # Writes a run of spectra for the same file with one write_many if it is
+    # stacked. If that fails (e.g. one spectrum has an attribute that is not a
+    # column), or for the 'datasets' layout, where write_many would stop half
+    # way, they are written one at a time, so only the failing ones are lost
+    # and logged.
+    # Files are opened without the lock, so the listener keeps answering
+    # (checking against pending) while a file in use is waited for.
+    def _write_run(self, run):
+        header = run[0][0]
+        filename = header['filename']
+        writer = self.writers.get(filename) # Only this thread adds or removes writers
+        if writer is None:
+            try:
+                writer = biasSpectroscopyWriter(filename, *self._options(header), open_timeout = self.open_timeout)
+            except Exception:
+                self._log_error()
+                with self._lock:
+                    self.pending.pop(filename, None)
+                return
+        with self._lock:
+            self.writers[filename] = writer
+            self.pending.pop(filename, None)
+            try:
+                writer.check_options(*self._options(header))
+            except Exception:
+                self._log_error()
+                return
+            if (writer.layout == 'stacked') and (len(run) > 1):
+                try:
+                    writer.write_many([h['attributes'] for h, _ in run], header['channels'], np.stack([d for _, d in run]))
+                    return
+                except Exception:
+                    pass
+            for h, d in run:
+                try:
+                    writer.write(h['attributes'], h['channels'], d)
+                except Exception:
+                    self._log_error()
+
+    def _flush_all(self):
+        for writer in self.writers.values():
+            try:
+                writer.flush()
+            except Exception:
+                self._log_error()
+
+    def _close(self, filename):
+        filenames = list(self.writers.keys()) if filename is None else [filename]
+        for name in filenames:
+            writer = self.writers.pop(name, None)
+            if writer is not None:
+                try:
+                    writer.close()
+                except Exception:
+                    self._log_error()
+
+if __name__ == '__main__':
+    spectroscopyWriterServer(port = int(sys.argv[1]) if len(sys.argv) > 1 else writer_port).serve_forever()
@@ -7,12 +7,37 @@ except ModuleNotFoundError:
     import pyvisa as visa
     
 import time
+import traceback
+import warnings
 import numpy as np
+with warnings.catch_warnings():
+    warnings.filterwarnings('ignore', category = FutureWarning)
+    import h5py
+
+import threading
+try:
+    import Queue
+except ModuleNotFoundError:
+    import queue as Queue
+
+# Status byte, as read by a serial poll. RQS <mask> selects the bits that
+# assert SRQ; the analyzer sets status_rqs along with them, and the serial
+# poll clears the byte.
+status_measurement_done = 4
+status_error = 32
+status_rqs = 64
 
 class SpectrumAnalyzer:
 
     def __init__(self, address = 7, gpib_num = 0):
         self.primary_id = 'GPIB' + str(gpib_num) + '::' +str(address) +'::INSTR'
+        self.setup_parameters = {}
+        self.use_srq = False
+        # Status byte bits that request service (see enable_srq). SMSD is only
+        # read after an SRQ, or as a safety net if none arrives for
+        # srq_check_time seconds.
+        self.srq_mask = status_measurement_done
+        self.srq_check_time = 5
         rm = visa.ResourceManager()
         if self.primary_id in rm.list_resources():
             self.inst = rm.open_resource(self.primary_id)
@@ -27,6 +52,7 @@ class SpectrumAnalyzer:
         self.inst.close()
 
     def setup(self, frequencySpan = 400, nAverages = 1): # Same setup procedure as Yazdani vibration.m
+        self.setup_parameters = {'frequencySpan': frequencySpan, 'nAverages': nAverages}
         self.write("AU1;") # AUTORANGE
         self.write("MGDB;")
         self.write("LINX;")
@@ -48,14 +74,59 @@ class SpectrumAnalyzer:
         self.write("XASC;")
         self.write("YASC;")
 
-    def get_ascii(self, queryTime = 0.1):
-        self.write("STRT;")
-        measDone = ""
+    # Makes the analyzer request service when a measurement finishes, so
+    # wait_for_measurement can leave the bus free instead of polling SMSD.
+    # mask is a combination of the status_* bits (default srq_mask).
+    def enable_srq(self, mask = None):
+        if mask is not None:
+            self.srq_mask = mask
+        self.inst.read_stb() # Clear any stale status before enabling
+        self.write("RQS " + str(self.srq_mask) + ";")
+        self.inst.enable_event(visa.constants.EventType.service_request, visa.constants.EventMechanism.queue)
+        self.use_srq = True
+
+    def disable_srq(self):
+        self.write("RQS 0;")
+        if self.use_srq:
+            self.inst.disable_event(visa.constants.EventType.service_request, visa.constants.EventMechanism.queue)
+        self.use_srq = False
+
+    # Waits for the measurement started by STRT to finish. With SRQ enabled,
+    # it waits for the service request event and reads the status byte with
+    # one serial poll (which clears it; pyvisa's wait_for_srq would poll and
+    # discard it itself), and confirms with SMSD only if the done bit is set
+    # or no SRQ came for srq_check_time seconds. Otherwise it polls SMSD
+    # every queryTime seconds.
+    # Raises TimeoutError if the measurement is not done after timeout seconds,
+    # and RuntimeError if the analyzer requests service for an error.
+    def wait_for_measurement(self, timeout = None, queryTime = 0.1):
+        deadline = None if timeout is None else time.time() + timeout
         while True:
-            measDone = self.read("SMSD;")
-            if measDone == "1\r\n":
-                break
-            time.sleep(queryTime)
+            if self.use_srq:
+                wait = self.srq_check_time
+                if deadline is not None:
+                    wait = max(min(wait, deadline - time.time()), 0)
+                try:
+                    self.inst.wait_on_event(visa.constants.EventType.service_request, int(1000 * wait))
+                    status = self.inst.read_stb()
+                except visa.VisaIOError: # No SRQ in time: check SMSD anyway
+                    status = None
+                if (status is not None) and (status & status_rqs) and (status & self.srq_mask & status_error):
+                    raise RuntimeError('HP 3562A requested service for an error (status byte ' + str(status) + ')')
+                # An SRQ without our RQS bit came from another instrument on the bus
+                check = (status is None) or ((status & status_rqs) and (status & status_measurement_done))
+            else:
+                check = True
+            if check and (self.read("SMSD;") == "1\r\n"):
+                return
+            if (deadline is not None) and (time.time() > deadline):
+                raise TimeoutError('HP 3562A measurement not done after ' + str(timeout) + ' s')
+            if not self.use_srq:
+                time.sleep(queryTime)
+
+    def get_ascii(self, queryTime = 0.1, timeout = None):
+        self.write("STRT;")
+        self.wait_for_measurement(timeout, queryTime)
         return self.read("DDAS;")
 
     def ascii_to_num(self, asciiValues):
@@ -63,36 +134,123 @@ class SpectrumAnalyzer:
         numericList = [float(elem) for elem in asciiList]
         return np.array(numericList[67:])
 
-    def get_binary(self, queryTime = 0.1):
+    def get_binary(self, queryTime = 0.1, timeout = None):
         self.write("STRT;")
-        measDone = ""
-        while True:
-            measDone = self.read("SMSD;")
-            if measDone == "1\r\n":
-                break
-            time.sleep(queryTime)
+        self.wait_for_measurement(timeout, queryTime)
         self.write("DDBN;")
         return self.inst.read_raw()
 
+    # Takes nTraces back-to-back measurements. Each trace is decoded (and
+    # appended to the HDF5 file, if given) in a second thread while the next
+    # one is measured. Returns (frequency, spectra) with one row per trace.
+    # In the file, each run is a group vibration/<start time> (with _2, _3, ...
+    # for runs started in the same second) holding
+    # 'spectra', 'time' (unix time of each trace) and 'frequency', with the
+    # setup() parameters as attributes.
+    def acquire_traces(self, nTraces, filename = None, queryTime = 0.1):
+        rawQueue = Queue.Queue()
+        result = {'spectra': [], 'frequency': None, 'error': None}
+        # Joined (not just signalled) so no h5py object outlives the call
+        decoder = threading.Thread(target = self._decode_traces, args = (rawQueue, filename, result))
+        decoder.start()
+        try:
+            for _ in range(nTraces):
+                if result['error'] is not None:
+                    break
+                rawValues = self.get_binary(queryTime)
+                rawQueue.put((time.time(), rawValues))
+        finally:
+            rawQueue.put(None)
+            decoder.join()
+        if result['error'] is not None:
+            raise result['error']
+        return result['frequency'], np.array(result['spectra'])
+
+    def _decode_traces(self, rawQueue, filename, result):
+        h5file = None
+        try:
+            while True:
+                item = rawQueue.get()
+                if item is None:
+                    break
+                if result['error'] is not None:
+                    continue
+                traceTime, rawValues = item
+                spectrum = self.binary_to_num(rawValues)
+                if result['frequency'] is None:
+                    header = parse_binary_header(rawValues)
+                    result['frequency'] = header['start_frequency'] + header['delta_x'] * np.arange(len(spectrum))
+                    if filename is not None:
+                        h5file = h5py.File(filename, 'a')
+                        vibration = h5file.require_group('vibration')
+                        name = time.strftime('%Y%m%d_%H%M%S')
+                        suffix = 1
+                        while (name if suffix == 1 else name + '_' + str(suffix)) in vibration:
+                            suffix += 1
+                        group = vibration.create_group(name if suffix == 1 else name + '_' + str(suffix))
+                        group.create_dataset('frequency', data = result['frequency'])
+                        spectra = group.create_dataset('spectra', shape = (0, len(spectrum)), maxshape = (None, len(spectrum)), chunks = (16, len(spectrum)), dtype = 'f8')
+                        times = group.create_dataset('time', shape = (0,), maxshape = (None,), chunks = (1024,), dtype = 'f8')
+                        for key, value in self.setup_parameters.items():
+                            group.attrs[key] = value
+                result['spectra'].append(spectrum)
+                if h5file is not None:
+                    spectra.resize((spectra.shape[0] + 1, spectra.shape[1]))
+                    spectra[-1] = spectrum[:spectra.shape[1]]
+                    times.resize((times.shape[0] + 1,))
+                    times[-1] = traceTime
+                    h5file.flush()
+        except Exception as e:
+            print(traceback.format_exc())
+            result['error'] = e
+        finally:
+            if h5file is not None:
+                h5file.close()
+
+    # Decodes a DDBN dump (or a list of dumps, giving one row per trace)
+    # into a numpy array
     def binary_to_num(self, binaryValues):
-        binData = binaryValues[168+4:]
-        nElems = int(len(binData)/4)
-        data = np.zeros(nElems)
-        for idx in range(nElems):
-            mantissa = (binData[4*idx] << 16) + (binData[4*idx+1] << 8) + (binData[4*idx+2])
-            mantissa *= (2**-23)
-            if (binData[4*idx] & 128) == 0:
-                pass
-            elif (binData[4*idx] & 128) == 128:
-                mantissa = -1 + mantissa # Is this correct?
-            else:
-                raise Exception("Unknown error calculating mantissa in binary_to_num")
-            exponent = binData[4*idx + 3]
-            if (exponent & 128) == 128:
-                exponent -= 256
-            elif (exponent & 128) == 0:
-                pass
-            else:
-                raise Exception("Unknown error calculating exponent in binary_to_num")
-            data[idx] = mantissa * (2**exponent)
-        return data
\ No newline at end of file
+        if isinstance(binaryValues, (list, tuple)):
+            headers = [parse_binary_header(values) for values in binaryValues]
+            nElems = min(header['number_of_elements'] for header in headers)
+            binData = b''.join(values[binary_data_offset:binary_data_offset + 4 * nElems] for values in binaryValues)
+            return hp_to_float(binData).reshape(len(binaryValues), nElems)
+        header = parse_binary_header(binaryValues)
+        binData = binaryValues[binary_data_offset:binary_data_offset + 4 * header['number_of_elements']]
+        return hp_to_float(binData)
+
+# A DDBN dump is '#A', a 2 byte block length, a 168 byte data header, then the trace
+binary_header_size = 168
+binary_data_offset = 4 + binary_header_size
+
+# Parses the block prefix and the data header entries used here: the leading
+# 2 byte integers (display function, number of elements, displayed elements,
+# number of averages), and the x axis, delta x (4 byte real at header byte 116)
+# and start frequency (8 byte real at header byte 152). The raw header bytes
+# are kept under 'raw'.
+def parse_binary_header(binaryValues):
+    if binaryValues[:2] != b'#A':
+        raise ValueError('Not an HP 3562A binary block')
+    header = binaryValues[4:binary_data_offset]
+    entries = np.frombuffer(header[:8], dtype = '>i2')
+    nAvailable = (len(binaryValues) - binary_data_offset) // 4
+    nElems = int(entries[1])
+    if not 0 < nElems <= nAvailable: # Trust the data over an unexpected header
+        nElems = nAvailable
+    return {'block_length': int(np.frombuffer(binaryValues[2:4], dtype = '>u2')[0]),
+            'display_function': int(entries[0]),
+            'number_of_elements': nElems,
+            'displayed_elements': int(entries[2]),
+            'number_of_averages': int(entries[3]),
+            'delta_x': float(hp_to_float(header[116:120])[0]),
+            'start_frequency': float(hp_to_float(header[152:160], 8)[0]),
+            'raw': header}
+
+# HP floating point: each 4 byte word is a 24 bit two's complement mantissa
+# (binary point after the sign bit) followed by an 8 bit two's complement
+# exponent. Long reals (size = 8) have a 56 bit mantissa.
+def hp_to_float(binData, size = 4):
+    words = np.frombuffer(binData[:len(binData) - len(binData) % size], dtype = '>i' + str(size))
+    mantissa = words >> 8 # Arithmetic shift keeps the sign
+    exponent = ((words & 0xFF) ^ 0x80) - 0x80
+    return np.ldexp(mantissa.astype(float), exponent - (8 * size - 9))
@@ -21,10 +21,17 @@ import socket
 import traceback
 import ast
 
+try:
+    from . import data_bus
+except ImportError: # Imported as a plain module rather than from the package
+    import data_bus
+
 class keithley2400:
 
-    def __init__(self, com_port='COM3', max_voltage=100, listen_port=None, increment=None, read_before_write=True, baud_rate=9600, timeout=0.1):
+    def __init__(self, com_port='COM3', max_voltage=100, listen_port=None, increment=None, read_before_write=True, baud_rate=9600, timeout=0.1, bus=None):
         self.keithley = serial.Serial(com_port, baud_rate, timeout = timeout)
+        self.bus = bus # Optional data_bus.dataBus
+        self.bus_source = 'keithley2400'
         self.lock = thread.allocate_lock()
         self.emergency_lock = 0
         self.MAXVOLTAGE = abs(max_voltage)
@@ -265,7 +272,7 @@ class keithley2400:
                     break
                 counter += 1
                 time.sleep(self._header_error_time)
-        return voltage
+        return data_bus.publish(self.bus, self.bus_source, 'voltage', voltage, 'V')
 
     def read_voltage(self):
         self.lock.acquire()
@@ -295,7 +302,7 @@ class keithley2400:
                     break
                 counter += 1
                 time.sleep(self._header_error_time)
-        return current
+        return data_bus.publish(self.bus, self.bus_source, 'current', current, 'uA')
 
     def read_current(self):
         self.lock.acquire()
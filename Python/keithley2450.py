@@ -3,6 +3,11 @@
 # Uses Keithley's Test Script Processor, an Lua interpreter
 # Sets to source voltage and measure current
 #
+# All instrument I/O is done by one thread (_execute) that takes jobs from a
+# queue, so the listener and interactive calls never collide on the USB session.
+# Readings are cached with a timestamp and served from the cache while they are
+# younger than max_age seconds.
+#
 # TO DO: Message boundaries for recv over TCP.
 
 try:
@@ -15,16 +20,64 @@ try:
 except ModuleNotFoundError:
     import _thread as thread
 
+try:
+    import Queue
+except ModuleNotFoundError:
+    import queue as Queue
+
 import time
 import socket
+import threading
 import traceback
 import atexit
 import ast
+import numpy as np
+
+# TSP functions uploaded once by load_buffered_script.
+# ult_sweep and ult_acquire run entirely on the instrument, storing into defbuffer1.
+# ult_printbuffer dumps (time, source, reading) for every point as little-endian float32.
+buffered_script_name = 'ultBuffered'
+buffered_script = [
+    'loadscript ' + buffered_script_name,
+    'function ult_sweep(start, stop, points, delay, nplc)',
+    '    defbuffer1.clear()',
+    '    smu.measure.nplc = nplc',
+    '    smu.source.sweeplinear("ultSweep", start, stop, points, delay, 1, smu.RANGE_BEST, smu.OFF, smu.OFF, defbuffer1)',
+    '    trigger.model.initiate()',
+    '    waitcomplete()',
+    'end',
+    'function ult_acquire(points, interval, nplc)',
+    '    defbuffer1.clear()',
+    '    smu.measure.nplc = nplc',
+    '    trigger.model.load("SimpleLoop", points, interval, defbuffer1)',
+    '    trigger.model.initiate()',
+    '    waitcomplete()',
+    'end',
+    'function ult_printbuffer()',
+    '    format.data = format.REAL32',
+    '    format.byteorder = format.LITTLEENDIAN',
+    '    printbuffer(1, defbuffer1.n, defbuffer1.relativetimestamps, defbuffer1.sourcevalues, defbuffer1.readings)',
+    '    format.data = format.ASCII',
+    'end',
+    'endscript',
+    buffered_script_name + '.run()']
+
+# A number as TSP source. repr would give e.g. np.float64(0.5) for NumPy scalars.
+def tsp_number(value):
+    return '%.9g' % float(value)
 
 class keithley2450:
 
-    def __init__(self, resource = None, listen_port = 65432):
+    def __init__(self, resource = None, listen_port = 65432, max_age = 0.5):
         self.listen_port = listen_port
+        self.max_age = max_age
+        self.read_attempts = 10
+        self.error_list = []
+        self.queue = Queue.Queue()
+        self._cache = {}
+        self._io_thread = None
+        self._submit_lock = threading.Lock() # Orders jobs against the stop sentinel
+        self._io_done = threading.Event()
         if resource:
             pass
         else: #If resource is not defined, pick the first Keithley 2450
@@ -40,7 +93,8 @@ class keithley2450:
         self.inst.write('smu.source.func = smu.FUNC_DC_VOLTAGE')
         self.inst.write('smu.measure.func = smu.FUNC_DC_CURRENT')
         self.on_flag = 1
-        thread.start_new_thread(self.start,())
+        self._script_loaded = False
+        thread.start_new_thread(self._execute,())
         thread.start_new_thread(self.listen,())
 
         @atexit.register
@@ -88,23 +142,52 @@ class keithley2450:
                         self.error_list.append(err)
                     time.sleep(0.5)
 
-    def start(self):
-        self.error_list = []
-        self.read_flag = 1
-        while self.on_flag:
-            try:
-                if self.read_flag:
-                    self.inst.write('smu.measure.read()')
-            except Exception:
-                if len(self.error_list) < 21:
-                    err = traceback.format_exc()
-                    print('ERROR in START thread:')
-                    print(err)
-                    self.error_list.append(err)
-            time.sleep(0.5)
+    # The only thread that talks to the instrument. Runs until the sentinel
+    # queued by stop(); jobs still queued then are failed, not dropped, so no
+    # caller is left waiting in _submit.
+    def _execute(self):
+        self._io_thread = thread.get_ident()
+        try:
+            while True:
+                job = self.queue.get()
+                if job is None:
+                    break
+                func, args, reply = job
+                if not self.on_flag:
+                    reply.put((False, RuntimeError('Keithley 2450 has been stopped')))
+                    continue
+                try:
+                    reply.put((True, func(*args)))
+                except Exception as e:
+                    if len(self.error_list) < 21:
+                        err = traceback.format_exc()
+                        print('ERROR in EXECUTE thread:')
+                        print(err)
+                        self.error_list.append(err)
+                    reply.put((False, e))
+        finally:
+            self._io_done.set()
+
+    # Runs func on the I/O thread and waits for its result
+    def _submit(self, func, *args):
+        if thread.get_ident() == self._io_thread:
+            return func(*args)
+        reply = Queue.Queue(1)
+        with self._submit_lock:
+            if not self.on_flag:
+                raise RuntimeError('Keithley 2450 has been stopped')
+            self.queue.put((func, args, reply))
+        success, result = reply.get()
+        if not success:
+            raise result
+        return result
 
     def stop(self):
-        self.on_flag = 0
+        with self._submit_lock:
+            self.on_flag = 0
+            self.queue.put(None)
+        if thread.get_ident() != self._io_thread:
+            self._io_done.wait() # The job in progress finishes before the session closes
         host = '127.0.0.1'
         port = self.listen_port
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -118,11 +201,13 @@ class keithley2450:
         self.stop()
 
     def write_to_instrument(self, *messages):
-        self.read_flag = 0
+        self._submit(self._write, messages)
+
+    def _write(self, messages):
+        self._cache.clear() # Any change to the source invalidates old readings
         for message in messages:
             self.inst.write(message)
         time.sleep(0.01)
-        self.read_flag = 1
 
     def output_on(self):
         self.write_to_instrument('smu.source.output = smu.ON')
@@ -168,25 +253,98 @@ class keithley2450:
             print('Set Overprotection to ' + str(protection_value) + 'V')
 
     def read_from_instrument(self, *messages):
-        self.read_flag = 0
-        while True:
+        return self._submit(self._read, messages)
+
+    def _read(self, messages):
+        for attempt in range(self.read_attempts):
             try:
                 self.inst.write('*CLS')
                 for message in messages:
                     self.inst.write(message)
-                result = float(self.inst.query('').strip())
+                result = [float(value) for value in self.inst.query('').split()]
                 self.inst.write('*CLS')
-                break
+                if not result:
+                    raise ValueError('Empty reply')
+                return result[0] if len(result) == 1 else result
             except ValueError:
                 pass
-        self.read_flag = 1
+        raise ValueError('No valid reply from Keithley 2450 after ' + str(self.read_attempts) + ' attempts')
+
+    # Returns the cached value of key if it is younger than max_age seconds,
+    # otherwise reads it with messages. Runs on the I/O thread, so requests
+    # queued behind a read are served by that read.
+    def _cached_read(self, key, messages, max_age):
+        if max_age is None:
+            max_age = self.max_age
+        entry = self._cache.get(key)
+        if (entry is not None) and (time.time() - entry[0] <= max_age):
+            return entry[1]
+        value = self._read(messages)
+        self._cache[key] = (time.time(), value)
+        return value
+
+    # One measurement gives both the current and the voltage it was taken at
+    def _measure(self, max_age):
+        result = self._submit(self._cached_read, 'measurement', ('print(smu.measure.read(defbuffer1), defbuffer1.sourcevalues[defbuffer1.endindex])',), max_age)
+        if not (isinstance(result, list) and len(result) == 2):
+            raise ValueError('Expected a current and a voltage from Keithley 2450, got ' + str(result))
         return result
 
-    def read_voltage(self):
-        return self.read_from_instrument('smu.measure.read(defbuffer1)','print(defbuffer1.sourcevalues[defbuffer1.endindex])')
+    def read_voltage(self, max_age = None):
+        return self._measure(max_age)[1]
+
+    def read_current(self, max_age = None):
+        return self._measure(max_age)[0]
+
+    def read_setpoint(self, max_age = None):
+        return self._submit(self._cached_read, 'setpoint', ('print(smu.source.level)',), max_age)
+
+    # Uploads the TSP sweep/acquisition functions (only once per session)
+    def load_buffered_script(self):
+        if not self._script_loaded:
+            self.write_to_instrument(*buffered_script)
+            self._script_loaded = True
+
+    # Runs a linear voltage sweep on the instrument and returns an (N, 3) array
+    # of time (s), voltage (V) and current (A), one row per point
+    def sweep_voltage(self, start, stop, points, delay = 0, nplc = 1):
+        return self._run_buffered('ult_sweep(%s, %s, %d, %s, %s)' % (tsp_number(start), tsp_number(stop), int(points), tsp_number(delay), tsp_number(nplc)),
+                                  points * (delay + nplc / 50.0))
+
+    # Measures points readings interval seconds apart at the present source level
+    # and returns an (N, 3) array of time (s), voltage (V) and current (A)
+    def acquire(self, points, interval = 0, nplc = 1):
+        return self._run_buffered('ult_acquire(%d, %s, %s)' % (int(points), tsp_number(interval), tsp_number(nplc)), points * (interval + nplc / 50.0))
+
+    def _run_buffered(self, command, expected_time):
+        self.load_buffered_script()
+        return self._submit(self._run_buffered_io, command, expected_time)
+
+    # defbuffer1 and the error queue are cleared first, so a call the instrument
+    # rejects raises instead of returning the previous run's data
+    def _run_buffered_io(self, command, expected_time):
+        self._cache.clear()
+        timeout = self.inst.timeout
+        try:
+            self.inst.timeout = max(timeout, 1000 * (2 * expected_time + 10))
+            self.inst.write('errorqueue.clear()')
+            self.inst.write('defbuffer1.clear()')
+            self.inst.write(command)
+            if int(float(self.inst.query('print(errorqueue.count)').strip())) > 0: # Waits for the run to finish
+                raise ValueError('Keithley 2450 rejected ' + command + ': ' + self.inst.query('print(errorqueue.next())').strip())
+            return self._read_buffer()
+        finally:
+            self.inst.timeout = timeout
 
-    def read_current(self):
-        return self.read_from_instrument('print(smu.measure.read(defbuffer1))')
+    # Reads all of defbuffer1 in one binary transfer
+    def read_buffer(self):
+        self.load_buffered_script()
+        return self._submit(self._read_buffer)
 
-    def read_setpoint(self):
-        return self.read_from_instrument('print(smu.source.level)')
+    def _read_buffer(self):
+        points = int(float(self.inst.query('print(defbuffer1.n)').strip())) # Waits for the sweep to finish
+        if points == 0:
+            return np.zeros((0, 3))
+        values = self.inst.query_binary_values('ult_printbuffer()', datatype = 'f', is_big_endian = False,
+                                               data_points = 3 * points, container = np.array)
+        return values.reshape(-1, 3).astype(float)
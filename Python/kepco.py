@@ -6,11 +6,18 @@ try:
 except ModuleNotFoundError:
     import pyvisa as visa
 
+try:
+    from . import data_bus
+except ImportError: # Imported as a plain module rather than from the package
+    import data_bus
+
 class kepco:
 
     #The primary address is assumed to be 6
-    def __init__(self, address = 6, gpib_num = 1):
+    def __init__(self, address = 6, gpib_num = 1, bus = None):
         self.primary_id = 'GPIB' + str(gpib_num) + '::' +str(address) +'::INSTR'
+        self.bus = bus # Optional data_bus.dataBus
+        self.bus_source = 'kepco'
 
     #Measures voltage
     def query(self, message):
@@ -25,8 +32,8 @@ class kepco:
 
     #Measures volgage
     def read_voltage(self):
-        return float(self.query('MEAS:SCAL:VOLT?'))
+        return data_bus.publish(self.bus, self.bus_source, 'voltage', float(self.query('MEAS:SCAL:VOLT?')), 'V')
 
     #Measures current
     def read_current(self):
-        return float(self.query('MEAS:SCAL:CURR?'))
+        return data_bus.publish(self.bus, self.bus_source, 'current', float(self.query('MEAS:SCAL:CURR?')), 'A')
@@ -9,28 +9,98 @@ try:
 except ModuleNotFoundError:
     import _thread as thread
 import atexit
+import itertools
+import math
+import threading
+from collections import deque
+try:
+    import Queue
+except ModuleNotFoundError:
+    import queue as Queue
+
+# Priority lanes for the serial command queue (lower goes first).
+# Safety commands jump ahead of everything already waiting, and fail the
+# set commands still waiting for their axis (see _cancel_queued_sets), so a
+# ramp queued before a hold can't run after it and undo it.
+priority_safety = 0
+priority_set = 1
+priority_read = 2
+priority_poll = 3
+
+# Readings returned by mercuryIPS.all_axes_status (and kept by the status poller) for each axis:
+# (name, command abbreviation, unit or None for a string reply)
+status_items = [
+    ('field', 'SIG:FLD?', 'T'),
+    ('current', 'SIG:CURR?', 'A'),
+    ('voltage', 'SIG:VOLT?', 'V'),
+    ('state', 'ACTN?', None),
+    ('switch_heater', 'SIG:SWHT?', None)]
+
+def parse_bool(value):
+    if value.lower() in ['1', 'true', 'fresh']:
+        return True
+    if value.lower() in ['0', 'false']:
+        return False
+    raise ValueError('Not a boolean: ' + value)
+
+# Argument parsers for listener commands that take arguments
+listen_argument_types = {
+    'read_state': (parse_bool,),
+    'read_switch_heater': (parse_bool,),
+    'read_voltage': (parse_bool,),
+    'read_current': (parse_bool,),
+    'read_field': (parse_bool,),
+    'set_target_field': (float,),
+    'set_ramp_rate': (float,),
+    'sweep_field': (float, float)}
 
 class mercuryIPS:
 
-    def __init__(self, com_port = 'COM6'):
+    def __init__(self, com_port = 'COM6', bus = None):
+        self.bus = bus # Optional data_bus.dataBus; gets every status reading as e.g. 'X_field'
+        self.bus_source = 'magnet'
         self._power_supply = serial.Serial(com_port, 9600, timeout = 1)
         self.x = vectorDirection(self, 'X')
         self.y = vectorDirection(self, 'Y')
         self.z = vectorDirection(self, 'Z')
         self.on_flag = 1
         self._listen_state = 0
+        self.listen_quiet = False
         self.error_list = []
+        # (direction, command) : (method, argument parsers), built once for the listener
+        self._dispatch = {}
+        for axis in [self.x, self.y, self.z]:
+            for name, method in axis._commands.items():
+                self._dispatch[(axis._direction, name)] = (method, listen_argument_types.get(name, ()))
+        self._command_queue = Queue.PriorityQueue()
+        self._command_counter = itertools.count()
+        self._queue_lock = threading.Lock() # Nothing is queued once close() has queued its sentinel
+        self._owner_thread = None
+        self._owner_state = 1
+        thread.start_new_thread(self._serial_owner,())
+        self._poll_flag = False
+        self._poll_state = 0
+        self.poll_interval = 1.0
+        self._status = {} # direction : (time, status dictionary)
+        self.sweeps = {} # direction : most recent fieldSweep
+        self.max_vector_field = 1.0 # T, for vector moves off the Z axis
+        self.max_ramp_rate = 0.5 # T/min, as enforced by vectorDirection.set_ramp_rate
+        # A vector move may take its ramp time times ramp_timeout_factor plus
+        # ramp_timeout_margin seconds before set_vector_field gives up
+        self.ramp_timeout_factor = 1.5
+        self.ramp_timeout_margin = 60.0
+        self._event_state = 0
+        self._event_subscribers = []
 
         @atexit.register
         def exit_handler():
             self.close()
 
+    # Commands arrive as '<direction> <command> [arguments]\n', e.g. 'Z read_field\n'.
+    # Several may be sent in one request separated by ';', e.g.
+    # 'X read_field; Y read_field; Z read_field\n', and the replies come back
+    # on one line in the same order, separated by ';'.
     def listen(self):
-        def parse_value(value):
-            try:
-                return float(value)
-            except:
-                return value
         self._listen_state = 1
         host = '127.0.0.1'
         port = 65242
@@ -40,77 +110,184 @@ class mercuryIPS:
         s.listen(0)
         while self.on_flag:
             conn, addr = s.accept()
-            listen_string = conn.recv(1024).decode()
-            if listen_string == 'QUIT':
-                s.close()
-            else:
-                if self.on_flag == 0:
+            try:
+                listen_string = conn.recv(1024).decode()
+                if listen_string == 'QUIT':
+                    s.close()
+                elif self.on_flag == 0:
                     break
-                try:
-                    if listen_string[-1] == '\n':
-                        listen_commands = listen_string.strip().split()
-                        if listen_commands[0].upper() == 'X':
-                            dir_obj = self.x
-                        elif listen_commands[0].upper() == 'Y':
-                            dir_obj = self.y
-                        elif listen_commands[0].upper() == 'Z':
-                            dir_obj = self.z
-                        else:
-                            print("LISTEN COMMAND MALFORMED. IGNORING COMMAND.")
-                            conn.sendall('ERROR: COMMAND ERROR. DIRECTION NOT X, Y, OR Z\n'.encode())
-                        try:
-                            comm_to_exec = dir_obj._commands[listen_commands[1].lower()]
-                            if comm_to_exec.__name__ != listen_commands[1].lower():
-                                raise KeyError
-                            if comm_to_exec.__self__._direction != listen_commands[0].upper():
-                                raise KeyError
-                        except KeyError:
-                            print("LISTEN COMMAND MALFORMED. IGNORING COMMAND.")
-                            conn.sendall('ERROR: COMMAND ERROR. COMMAND NOT RECOGNIZED\n'.encode())
-                        try:
-                            args_list = [parse_value(val) for val in listen_commands[2:]]
-                            result = None
-                            result = comm_to_exec(*args_list)
-                            print("EXECUTED:")
-                            print("\tDIRECTION: " + listen_commands[0].upper())
-                            print("\tCOMMAND: " + listen_commands[1].lower())
-                            print("\tARGUMENTS: " + ' '.join(listen_commands[2:]))
-                            if result is None:
-                                conn.sendall('NO DATA\n'.encode())
-                            else:
-                                conn.sendall((str(result) + '\n').encode())
-                        except TypeError:
-                            print("LISTEN COMMAND MALFORMED. IGNORING COMMAND.")
-                            conn.sendall('ERROR: COMMAND ERROR. WRONG NUMBER OF ARGUMENTS\n'.encode())
-                        except magnetException as e:
-                            print("LISTEN COMMAND ERROR. MAGNET EXCEPTION DETECTED.")
-                            conn.sendall(('ERROR: MAGNET EXCEPTION: ' + str(e) + '\n').encode())
-                    else:
+                elif listen_string[-1:] != '\n':
+                    if not self.listen_quiet:
                         print("LISTEN COMMAND MALFORMED. IGNORING COMMAND.")
-                        conn.sendall('ERROR: COMMAND ERROR. NEEDS LINE FEED\n'.encode())
-                    dir_obj = None
-                except Exception:
-                    if len(self.error_list) < 21:
-                        err = traceback.format_exc()
-                        print(err)
-                        self.error_list.append(err)
-                    time.sleep(0.5)
+                    conn.sendall('ERROR: COMMAND ERROR. NEEDS LINE FEED\n'.encode())
+                else:
+                    replies = [self._dispatch_command(command) for command in listen_string.split(';') if command.strip()]
+                    conn.sendall((';'.join(replies) + '\n').encode())
+            except Exception:
+                if len(self.error_list) < 21:
+                    err = traceback.format_exc()
+                    print(err)
+                    self.error_list.append(err)
+                time.sleep(0.5)
+            finally:
+                conn.close()
         self._listen_state = 0
 
-    def start_listen(self):
+    # Runs one listener command and returns its reply (without line feed).
+    # Errors come back as 'ERROR: ...' replies rather than exceptions, so each
+    # command of a ';' batch gets its own reply.
+    def _dispatch_command(self, command):
+        words = command.split()
+        direction = words[0].upper()
+        if direction not in ['X', 'Y', 'Z']:
+            if not self.listen_quiet:
+                print("LISTEN COMMAND MALFORMED. IGNORING COMMAND.")
+            return 'ERROR: COMMAND ERROR. DIRECTION NOT X, Y, OR Z'
+        entry = self._dispatch.get((direction, words[1].lower() if len(words) > 1 else ''))
+        if entry is None:
+            if not self.listen_quiet:
+                print("LISTEN COMMAND MALFORMED. IGNORING COMMAND.")
+            return 'ERROR: COMMAND ERROR. COMMAND NOT RECOGNIZED'
+        func, parsers = entry
+        if len(words) - 2 > len(parsers):
+            if not self.listen_quiet:
+                print("LISTEN COMMAND MALFORMED. IGNORING COMMAND.")
+            return 'ERROR: COMMAND ERROR. WRONG NUMBER OF ARGUMENTS'
+        try:
+            args_list = [parser(value) for parser, value in zip(parsers, words[2:])]
+        except ValueError:
+            if not self.listen_quiet:
+                print("LISTEN COMMAND MALFORMED. IGNORING COMMAND.")
+            return 'ERROR: COMMAND ERROR. INVALID ARGUMENT'
+        try:
+            result = func(*args_list)
+        except TypeError:
+            if not self.listen_quiet:
+                print("LISTEN COMMAND MALFORMED. IGNORING COMMAND.")
+            return 'ERROR: COMMAND ERROR. WRONG NUMBER OF ARGUMENTS'
+        except magnetException as e:
+            if not self.listen_quiet:
+                print("LISTEN COMMAND ERROR. MAGNET EXCEPTION DETECTED.")
+            return 'ERROR: MAGNET EXCEPTION: ' + str(e)
+        except Exception as e: # Any other failure (e.g. a serial error) only fails this command of a batch
+            if len(self.error_list) < 21:
+                err = traceback.format_exc()
+                print(err)
+                self.error_list.append(err)
+            return 'ERROR: ' + type(e).__name__ + ': ' + str(e)
+        if not self.listen_quiet:
+            print("EXECUTED:\n\tDIRECTION: " + direction + "\n\tCOMMAND: " + words[1].lower() + "\n\tARGUMENTS: " + ' '.join(words[2:]))
+        if result is None:
+            return 'NO DATA'
+        return str(result)
+
+    # With quiet = True, the listener does not print each command it executes
+    def start_listen(self, quiet = False):
+        self.listen_quiet = quiet
         if self._listen_state == 0:
             thread.start_new_thread(self.listen,())
         else:
             print("MAGNET LISTEN LOOP ALREADY RUNNING.")
 
-    def query(self, command):
+    # The only thread that uses the serial port. Runs queued transactions in
+    # priority order, FIFO within a lane, and hands each result back to the
+    # caller that queued it. Anything left after close()'s sentinel is failed,
+    # so no caller waits forever.
+    def _serial_owner(self):
+        self._owner_thread = thread.get_ident()
+        while True:
+            _, _, func, args, reply = self._command_queue.get()
+            if func is None:
+                break
+            try:
+                reply.put((True, func(*args)))
+            except Exception as e:
+                reply.put((False, e))
+        while not self._command_queue.empty():
+            _, _, func, args, reply = self._command_queue.get()
+            if reply is not None:
+                reply.put((False, magnetException('Magnet controller closed')))
+        self._owner_state = 0
+
+    # Runs func(*args) on the serial owner thread and waits for its result
+    def _transact(self, priority, func, *args):
+        if thread.get_ident() == self._owner_thread:
+            return func(*args)
+        reply = Queue.Queue(1)
+        with self._queue_lock:
+            if not self.on_flag:
+                raise magnetException('Magnet controller closed')
+            if priority == priority_safety:
+                self._cancel_queued_sets(self._command_axis(func, args))
+            self._command_queue.put((priority, next(self._command_counter), func, args, reply))
+        success, result = reply.get()
+        if not success:
+            raise result
+        return result
+
+    # Axis of a queued single SET command, or None for anything else
+    def _command_axis(self, func, args):
+        if (func == self._query) and args[0].startswith('SET:DEV:GRP'):
+            return args[0][len('SET:DEV:GRP')]
+        return None
+
+    # Fails every queued priority_set job for axis, and every one that is not
+    # a single SET for another axis. Called with _queue_lock held.
+    def _cancel_queued_sets(self, axis):
+        kept = []
+        while True:
+            try:
+                item = self._command_queue.get_nowait()
+            except Queue.Empty:
+                break
+            priority, _, func, args, reply = item
+            job_axis = self._command_axis(func, args)
+            if (priority == priority_set) and ((axis is None) or (job_axis is None) or (job_axis == axis)):
+                reply.put((False, magnetException('Cancelled by a safety command on ' + str(axis))))
+            else:
+                kept.append(item)
+        for item in kept:
+            self._command_queue.put(item)
+
+    def query(self, command, priority = priority_read):
+        return self._transact(priority, self._query, command)
+
+    def _query(self, command):
         self._power_supply.write(command.encode())
         return self._power_supply.readline().decode()
 
-    def set(self, direction, command_abbrev):
+    # Sends all commands in one write, then matches each reply line to its
+    # command by the path the power supply echoes back, e.g.
+    # READ:DEV:GRPX:PSU:SIG:FLD? -> STAT:DEV:GRPX:PSU:SIG:FLD:0.1000T
+    # Returns the replies in command order ('' for any that never arrived).
+    def query_many(self, commands, priority = priority_read):
+        return self._transact(priority, self._query_many, commands)
+
+    def _query_many(self, commands):
+        pending = {}
+        for idx, command in enumerate(commands):
+            path = command.strip().rstrip('?').split(':', 1)[-1]
+            pending.setdefault(path + ':', []).append(idx)
+        replies = [''] * len(commands)
+        self._power_supply.write(''.join(commands).encode())
+        remaining = len(commands)
+        while remaining > 0:
+            line = self._power_supply.readline().decode()
+            if line == '': # Timed out
+                break
+            body = line.strip().split(':', 1)[-1]
+            for path, indices in pending.items():
+                if indices and body.startswith(path):
+                    replies[indices.pop(0)] = line
+                    remaining -= 1
+                    break
+        return replies
+
+    def set(self, direction, command_abbrev, priority = priority_set):
         if direction.upper() not in ['X', 'Y', 'Z']: # direction is a string
             raise magnetException('Direction is not X, Y, or Z')
-        reply = self.query('SET:DEV:GRP' + direction.upper() + ':PSU:' + command_abbrev + '\r\n')
+        reply = self.query('SET:DEV:GRP' + direction.upper() + ':PSU:' + command_abbrev + '\r\n', priority)
+        self._status.pop(direction.upper(), None) # The snapshot may no longer be true
         result = reply.strip().split(':')[-1]
         if result == '':
             # print("WARNING: EMPTY STRING RETURNED. CHECK CONNECTION TO MAGNET CONTROLLER")
@@ -119,16 +296,266 @@ class mercuryIPS:
             print('ERROR: INVALID QUERY')
         return result
 
-    def read(self, direction, command_abbrev):
-        if direction.upper() not in ['X', 'Y', 'Z']: # direction is a string
+    def read(self, direction, command_abbrev, priority = priority_read):
+        return self.read_many([(direction, command_abbrev)], priority)[0]
+
+    # Pipelined read of several (direction, command_abbrev) pairs
+    def read_many(self, requests, priority = priority_read):
+        for direction, _ in requests:
+            if direction.upper() not in ['X', 'Y', 'Z']: # direction is a string
+                raise magnetException('Direction is not X, Y, or Z')
+        commands = ['READ:DEV:GRP' + direction.upper() + ':PSU:' + command_abbrev + '\r\n' for direction, command_abbrev in requests]
+        if len(commands) == 1:
+            replies = [self.query(commands[0], priority)]
+        else:
+            replies = self.query_many(commands, priority)
+        results = []
+        for reply in replies:
+            result = reply.strip().split(':')[-1]
+            if result == '':
+                raise magnetException('Empty string returned. Check connection to magnet controller')
+            if result == 'INVALID':
+                print('ERROR: INVALID QUERY')
+            results.append(result)
+        return results
+
+    # Field, current, voltage, state and switch heater of all three axes.
+    # Returns {'X': {'field': ..., 'current': ..., 'voltage': ..., 'state': ..., 'switch_heater': ...}, 'Y': ..., 'Z': ...}
+    # Served from the poller's snapshot when it is running, unless fresh is True.
+    def all_axes_status(self, fresh = False):
+        if not fresh:
+            status = dict((direction, self._snapshot(direction)) for direction in ['X', 'Y', 'Z'])
+            if all(value is not None for value in status.values()):
+                return status
+        return self._read_all_axes()
+
+    # One pipelined burst for every status item on every axis
+    def _read_all_axes(self, priority = priority_read):
+        requests = [(direction, abbrev) for direction in ['X', 'Y', 'Z'] for _, abbrev, _ in status_items]
+        results = iter(self.read_many(requests, priority))
+        status = {}
+        for direction in ['X', 'Y', 'Z']:
+            status[direction] = {}
+            for name, _, unit in status_items:
+                result = next(results)
+                status[direction][name] = result if unit is None else self.str_to_num(result, unit)
+        return status
+
+    # Starts a thread that refreshes the status of all axes every interval seconds.
+    # While it runs, read_field, read_state, etc. are answered from the snapshot.
+    def start_poll(self, interval = 1.0):
+        self.poll_interval = interval
+        if self._poll_state == 0:
+            self._poll_flag = True
+            thread.start_new_thread(self._poll,())
+        else:
+            print("MAGNET POLL LOOP ALREADY RUNNING.")
+
+    def stop_poll(self):
+        self._poll_flag = False
+        self._status = {}
+
+    def _poll(self):
+        self._poll_state = 1
+        while self._poll_flag and self.on_flag:
+            try:
+                status = self._read_all_axes(priority_poll)
+                now = time.time()
+                if self._poll_flag:
+                    for direction, axis_status in status.items():
+                        self._status[direction] = (now, axis_status)
+                        self._publish_status(direction, axis_status, now)
+            except Exception:
+                if len(self.error_list) < 21:
+                    err = traceback.format_exc()
+                    print(err)
+                    self.error_list.append(err)
+            time.sleep(self.poll_interval)
+        self._poll_state = 0
+
+    # The polled status of one axis, or None if there is no recent snapshot
+    def _snapshot(self, direction):
+        if not self._poll_flag:
+            return None
+        entry = self._status.get(direction.upper())
+        if (entry is None) or (time.time() - entry[0] > 3 * self.poll_interval + 1):
+            return None
+        return entry[1]
+
+    def _read_status(self, direction, name, fresh):
+        if not fresh:
+            snapshot = self._snapshot(direction)
+            if snapshot is not None:
+                return snapshot[name]
+        for item_name, command_abbrev, unit in status_items:
+            if item_name == name:
+                result = self.read(direction, command_abbrev)
+                result = result if unit is None else self.str_to_num(result, unit)
+                self._publish_status(direction, {name: result})
+                return result
+
+    def _publish_status(self, direction, axis_status, timestamp = None):
+        if self.bus is None:
+            return
+        units = dict((name, unit) for name, _, unit in status_items)
+        for name, value in axis_status.items():
+            self.bus.publish(self.bus_source, direction.upper() + '_' + name, value, units.get(name) or '', timestamp)
+
+    # Ramps one axis through each field in targets (T) at rate (T/min), holding
+    # at each one. Field readings are streamed into the returned fieldSweep's
+    # ring buffer (and hdf5_filename if given), and a "reached setpoint" event
+    # goes to its subscribers and to clients of start_events. If a setpoint is
+    # not reached within setpoint_timeout (see fieldSweep), the axis is held
+    # and the sweep ends with error set.
+    def sweep_field(self, direction, targets, rate, tolerance = 0.001, dwell = 0, sample_time = 0.5,
+                    buffer_size = 100000, hdf5_filename = None):
+        direction = direction.upper()
+        if direction not in ['X', 'Y', 'Z']:
             raise magnetException('Direction is not X, Y, or Z')
-        reply = self.query('READ:DEV:GRP' + direction.upper() + ':PSU:' + command_abbrev + '\r\n')
-        result = reply.strip().split(':')[-1]
-        if result == '':
-            raise magnetException('Empty string returned. Check connection to magnet controller')
-        if result == 'INVALID':
-            print('ERROR: INVALID QUERY')
-        return result
+        if (direction in self.sweeps) and self.sweeps[direction].running:
+            raise magnetException('A field sweep is already running on ' + direction)
+        if isinstance(targets, (int, float)):
+            targets = [targets]
+        axis = getattr(self, direction.lower())
+        for target in targets:
+            axis.check_target_field(target)
+        if ((type(rate) != float) and (type(rate) != int)) or not 0 < rate <= self.max_ramp_rate:
+            raise magnetException('Ramp rate must be above 0 and at most ' + str(self.max_ramp_rate) + ' T/min')
+        sweep = fieldSweep(self, direction, targets, rate, tolerance, dwell, sample_time, buffer_size, hdf5_filename)
+        self.sweeps[direction] = sweep
+        sweep.start()
+        return sweep
+
+    # Moves the field vector to (bx, by, bz) in T along a straight line. Each
+    # axis gets a ramp rate proportional to its share of the move, so all three
+    # arrive together and the field vector moves at rate (T/min), scaled down
+    # if an axis would exceed max_ramp_rate. Per-axis limits are those of
+    # vectorDirection.set_target_field; max_vector_field limits |B| whenever
+    # X or Y is nonzero, along the whole path and not just at the target (see
+    # _vector_path). If the path has to go through a waypoint on the Z axis,
+    # this waits for the waypoint even with wait = False.
+    # With wait = True, returns the final (bx, by, bz).
+    def set_vector_field(self, bx, by, bz, rate, wait = False, tolerance = 0.001, sample_time = 0.5):
+        target = (bx, by, bz)
+        for idx, direction in enumerate(['X', 'Y', 'Z']):
+            getattr(self, direction.lower()).check_target_field(target[idx])
+        if (bx != 0 or by != 0) and math.sqrt(bx ** 2 + by ** 2 + bz ** 2) > self.max_vector_field:
+            raise magnetException('Exceeds vector field limit of ' + str(self.max_vector_field) + ' T')
+        if rate <= 0:
+            raise magnetException('Do not set a negative ramp rate')
+        status = self.all_axes_status(fresh = True)
+        start = tuple(status[direction]['field'] for direction in ['X', 'Y', 'Z'])
+        path = self._vector_path(start, target, tolerance)
+        for waypoint in path[:-1]:
+            duration = self._ramp_vector(start, waypoint, rate)
+            start = self._wait_for_vector(waypoint, tolerance, sample_time, duration)
+        duration = self._ramp_vector(start, target, rate)
+        if not wait:
+            return
+        return self._wait_for_vector(target, tolerance, sample_time, duration)
+
+    # Splits the move from start to target into straight segments along which
+    # |B| <= max_vector_field wherever X or Y is nonzero. Along a straight line
+    # |B| is largest at one of the ends, so a segment is safe if neither end has
+    # transverse field or both ends are inside the limit. Otherwise the field
+    # outside the limit is only ever reached along the Z axis: from outside,
+    # Z is ramped alone to the target's Z first; towards outside, X and Y are
+    # ramped to zero first.
+    def _vector_path(self, start, target, tolerance):
+        def transverse(field):
+            return math.hypot(field[0], field[1]) > tolerance
+        def inside(field):
+            return math.sqrt(sum(value ** 2 for value in field)) <= self.max_vector_field + tolerance
+        if not (transverse(start) or transverse(target)):
+            return [target]
+        if inside(start) and inside(target):
+            return [target]
+        if not inside(start):
+            if transverse(start):
+                raise magnetException('Field ' + str(start) + ' T is already outside the vector field limit of ' +
+                                      str(self.max_vector_field) + ' T with X or Y nonzero')
+            return [(0.0, 0.0, target[2]), target]
+        return [(0.0, 0.0, start[2]), target]
+
+    # Starts a straight-line ramp of the axes from start to target and returns
+    # how long it should take (s)
+    def _ramp_vector(self, start, target, rate):
+        delta = [target[idx] - start[idx] for idx in range(3)]
+        distance = math.sqrt(sum(value ** 2 for value in delta))
+        if distance == 0:
+            return 0.0
+        rate = min(rate, self.max_ramp_rate * distance / max(abs(value) for value in delta))
+        for idx, direction in enumerate(['X', 'Y', 'Z']):
+            axis = getattr(self, direction.lower())
+            if delta[idx] != 0:
+                axis.set_ramp_rate(min(rate * abs(delta[idx]) / distance, self.max_ramp_rate))
+            axis.set_target_field(target[idx])
+        for idx, direction in enumerate(['X', 'Y', 'Z']):
+            if delta[idx] != 0:
+                self.ramp_to_set(direction)
+        return 60.0 * distance / rate
+
+    # Waits for the field to reach target. If it hasn't after the ramp
+    # duration (s) and the timeout allowance, holds every axis and raises
+    # magnetException.
+    def _wait_for_vector(self, target, tolerance, sample_time, duration):
+        deadline = time.time() + self.ramp_timeout_factor * duration + self.ramp_timeout_margin
+        while True:
+            status = self.all_axes_status(fresh = True)
+            field = tuple(status[direction]['field'] for direction in ['X', 'Y', 'Z'])
+            if all(abs(field[idx] - value) <= tolerance for idx, value in enumerate(target)):
+                return field
+            if time.time() > deadline:
+                for direction in ['X', 'Y', 'Z']:
+                    self.hold(direction)
+                raise magnetException('Field did not reach ' + str(target) + ' T in time; held at ' + str(field) + ' T')
+            time.sleep(sample_time)
+
+    # Same as set_vector_field with the target in spherical coordinates:
+    # magnitude (T), theta (degrees from +Z) and phi (degrees from +X towards +Y)
+    def set_vector_field_spherical(self, magnitude, theta, phi, rate, wait = False, tolerance = 0.001, sample_time = 0.5):
+        theta = math.radians(theta)
+        phi = math.radians(phi)
+        # Round so that e.g. theta = 0 gives exactly zero transverse field
+        bx = round(magnitude * math.sin(theta) * math.cos(phi), 9)
+        by = round(magnitude * math.sin(theta) * math.sin(phi), 9)
+        bz = round(magnitude * math.cos(theta), 9)
+        return self.set_vector_field(bx, by, bz, rate, wait, tolerance, sample_time)
+
+    # Accepts subscribers on port. Each subscriber is sent one line per event:
+    # 'REACHED <direction> <target> <unix time>' or 'DONE <direction> <unix time>'
+    def start_events(self, port = 65243):
+        if self._event_state == 0:
+            thread.start_new_thread(self._events,(port,))
+        else:
+            print("MAGNET EVENT LOOP ALREADY RUNNING.")
+
+    def _events(self, port):
+        self._event_state = 1
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.event_sock = s
+        try:
+            s.bind(('127.0.0.1', port))
+            s.listen(5)
+            while self.on_flag:
+                conn, _ = s.accept()
+                self._event_subscribers.append(conn)
+        except Exception:
+            if self.on_flag and (len(self.error_list) < 21):
+                err = traceback.format_exc()
+                print(err)
+                self.error_list.append(err)
+        finally:
+            s.close()
+            self._event_state = 0
+
+    def _emit_event(self, message):
+        for conn in list(self._event_subscribers):
+            try:
+                conn.sendall((message + '\n').encode())
+            except Exception:
+                self._event_subscribers.remove(conn)
+                conn.close()
 
     def str_to_num(self, input, base_unit):
         un_len = len(base_unit)
@@ -141,27 +568,43 @@ class mercuryIPS:
             raise magnetException('Incorrect unit')
 
     def close(self):
-        self.on_flag = 0
+        with self._queue_lock:
+            if not self.on_flag:
+                return
+            self.on_flag = 0
+            # Lowest priority, so transactions already queued finish first
+            self._command_queue.put((priority_poll + 1, next(self._command_counter), None, (), None))
+        self._poll_flag = False
+        for _ in range(100):
+            if self._owner_state == 0:
+                break
+            time.sleep(0.05)
         self._power_supply.close()
         try:
             self.lis_sock.close()
         except:
             pass
+        try:
+            self.event_sock.close()
+        except:
+            pass
+        for conn in self._event_subscribers:
+            conn.close()
 
-    def read_state(self, direction):
-        return self.read(direction, 'ACTN?')
+    def read_state(self, direction, fresh = False):
+        return self._read_status(direction, 'state', fresh)
 
     def hold(self, direction):
-        return self.set(direction, 'ACTN:HOLD')
+        return self.set(direction, 'ACTN:HOLD', priority_safety)
 
     def ramp_to_set(self, direction):
         return self.set(direction, 'ACTN:RTOS')
 
     def ramp_to_zero(self, direction):
-        return self.set(direction, 'ACTN:RTOZ')
+        return self.set(direction, 'ACTN:RTOZ', priority_safety)
 
-    def read_switch_heater(self, direction):
-        return self.read(direction, 'SIG:SWHT?')
+    def read_switch_heater(self, direction, fresh = False):
+        return self._read_status(direction, 'switch_heater', fresh)
 
     def switch_heater_on(self, direction):
         return self.set(direction, 'SIG:SWHT:ON')
@@ -169,17 +612,14 @@ class mercuryIPS:
     def switch_heater_off(self, direction):
         return self.set(direction, 'SIG:SWHT:OFF')
 
-    def read_voltage(self, direction):
-        result = self.read(direction, 'SIG:VOLT?')
-        return self.str_to_num(result, 'V')
+    def read_voltage(self, direction, fresh = False):
+        return self._read_status(direction, 'voltage', fresh)
 
-    def read_current(self, direction):
-        result = self.read(direction, 'SIG:CURR?')
-        return self.str_to_num(result, 'A')
+    def read_current(self, direction, fresh = False):
+        return self._read_status(direction, 'current', fresh)
 
-    def read_field(self, direction):
-        result = self.read(direction, 'SIG:FLD?')
-        return self.str_to_num(result, 'T')
+    def read_field(self, direction, fresh = False):
+        return self._read_status(direction, 'field', fresh)
 
     def read_persistent_field(self, direction):
         result = self.read(direction, 'SIG:PFLD?')
@@ -218,10 +658,12 @@ class vectorDirection:
                             "read_target_field": self.read_target_field, \
                             "set_target_field": self.set_target_field, \
                             "read_ramp_rate": self.read_ramp_rate, \
-                            "set_ramp_rate": self.set_ramp_rate}
+                            "set_ramp_rate": self.set_ramp_rate, \
+                            "sweep_field": self.sweep_field, \
+                            "stop_sweep": self.stop_sweep}
 
-    def read_state(self):
-        return self._IPS_instance.read_state(self._direction)
+    def read_state(self, fresh = False):
+        return self._IPS_instance.read_state(self._direction, fresh)
 
     def hold(self):
         return self._IPS_instance.hold(self._direction)
@@ -232,8 +674,8 @@ class vectorDirection:
     def ramp_to_zero(self):
         return self._IPS_instance.ramp_to_zero(self._direction)
 
-    def read_switch_heater(self):
-        return self._IPS_instance.read_switch_heater(self._direction)
+    def read_switch_heater(self, fresh = False):
+        return self._IPS_instance.read_switch_heater(self._direction, fresh)
 
     def switch_heater_on(self):
         return self._IPS_instance.switch_heater_on(self._direction)
@@ -241,14 +683,14 @@ class vectorDirection:
     def switch_heater_off(self):
         return self._IPS_instance.switch_heater_off(self._direction)
 
-    def read_voltage(self):
-        return self._IPS_instance.read_voltage(self._direction)
+    def read_voltage(self, fresh = False):
+        return self._IPS_instance.read_voltage(self._direction, fresh)
 
-    def read_current(self):
-        return self._IPS_instance.read_current(self._direction)
+    def read_current(self, fresh = False):
+        return self._IPS_instance.read_current(self._direction, fresh)
 
-    def read_field(self):
-        return self._IPS_instance.read_field(self._direction)
+    def read_field(self, fresh = False):
+        return self._IPS_instance.read_field(self._direction, fresh)
 
     def read_persistent_field(self):
         return self._IPS_instance.read_persistent_field(self._direction)
@@ -257,15 +699,19 @@ class vectorDirection:
         return self._IPS_instance.read_target_field(self._direction)
 
     def set_target_field(self, value):
+        self.check_target_field(value)
+        return self._IPS_instance.set_target_field(self._direction, value)
+
+    # Raises magnetException if value is not an allowed set point for this axis
+    def check_target_field(self, value):
         if (type(value) != float) and (type(value) != int):
             raise magnetException('Input value is not a number')
-        if (self._direction == 'X') or (self._direction == 'X'):
+        if (self._direction == 'X') or (self._direction == 'Y'):
             if abs(value) > 1:
                 raise magnetException('Exceeds field limit')
         if self._direction == 'Z':
             if abs(value) > 9:
                 raise magnetException('Exceeds field limit for Z for 9-1-1 T magnet')
-        return self._IPS_instance.set_target_field(self._direction, value)
 
     def read_ramp_rate(self):
         return self._IPS_instance.read_ramp_rate(self._direction)
@@ -282,6 +728,174 @@ class vectorDirection:
                 print('WARNING: RAMP RATE SET > 0.1 T/min')
         return self._IPS_instance.set_ramp_rate(self._direction, value)
 
+    def sweep_field(self, targets, rate, **kwargs):
+        return self._IPS_instance.sweep_field(self._direction, targets, rate, **kwargs)
+
+    def stop_sweep(self):
+        sweep = self._IPS_instance.sweeps.get(self._direction)
+        if (sweep is not None) and sweep.running:
+            sweep.stop()
+
+# A field sweep on one axis, run by mercuryIPS.sweep_field in its own thread.
+# Each setpoint must be reached within its ramp time, |target - field| / rate,
+# times timeout_factor plus timeout_margin seconds.
+class fieldSweep:
+
+    timeout_factor = 1.5
+    timeout_margin = 60.0
+
+    def __init__(self, IPS_instance, direction, targets, rate, tolerance, dwell, sample_time, buffer_size, hdf5_filename):
+        self._IPS_instance = IPS_instance
+        self.direction = direction
+        self.targets = list(targets)
+        self.rate = rate
+        self.tolerance = tolerance
+        self.dwell = dwell
+        self.sample_time = sample_time
+        self.hdf5_filename = hdf5_filename
+        self.times = deque(maxlen = buffer_size)
+        self.fields = deque(maxlen = buffer_size)
+        self.reached = [] # (time, target) for every setpoint reached
+        self.running = False
+        self.error = None
+        self._stop_flag = False
+        self._callbacks = []
+        self._condition = threading.Condition()
+
+    def __repr__(self):
+        state = 'RUNNING' if self.running else 'DONE'
+        return 'fieldSweep ' + self.direction + ' ' + state + ': ' + str(len(self.reached)) + ' of ' + str(len(self.targets)) + ' setpoints reached'
+
+    def start(self):
+        self.running = True
+        thread.start_new_thread(self._run,())
+
+    # Holds the axis and ends the sweep. The sweep thread holds it again once
+    # it has stopped sending commands, so a ramp it sent after this hold
+    # can't leave the axis ramping.
+    def stop(self):
+        self._stop_flag = True
+        self._IPS_instance.hold(self.direction)
+
+    # callback(direction, target, time) is called from the sweep thread at every setpoint
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    # Blocks until the next setpoint is reached and returns it, or returns None
+    # if the sweep ends or timeout seconds pass first
+    def wait_for_setpoint(self, timeout = None):
+        with self._condition:
+            count = len(self.reached)
+            if self.running:
+                self._condition.wait_for(lambda: (len(self.reached) > count) or not self.running, timeout)
+            if len(self.reached) > count:
+                return self.reached[count][1]
+        return None
+
+    # Snapshot of the ring buffer as numpy arrays (unix time, field in T)
+    def data(self):
+        import numpy as np
+        with self._condition:
+            return np.array(self.times), np.array(self.fields)
+
+    def _run(self):
+        axis = getattr(self._IPS_instance, self.direction.lower())
+        h5file = None
+        group = None
+        try:
+            if self.hdf5_filename is not None:
+                h5file, group = self._open_hdf5()
+            axis.set_ramp_rate(self.rate)
+            for target in self.targets:
+                if self._stop_flag:
+                    break
+                axis.set_target_field(target)
+                axis.ramp_to_set()
+                deadline = None
+                while not self._stop_flag:
+                    field = self._sample(axis, group)
+                    if abs(field - target) <= self.tolerance:
+                        break
+                    if deadline is None:
+                        deadline = time.time() + self.timeout_factor * 60.0 * abs(target - field) / self.rate + self.timeout_margin
+                    elif time.time() > deadline:
+                        axis.hold()
+                        raise magnetException(self.direction + ' did not reach ' + str(target) + ' T in time; held at ' + str(field) + ' T')
+                    time.sleep(self.sample_time)
+                if self._stop_flag:
+                    break
+                axis.hold()
+                dwell_end = time.time() + self.dwell
+                while (time.time() < dwell_end) and not self._stop_flag:
+                    time.sleep(min(self.sample_time, max(dwell_end - time.time(), 0)))
+                    self._sample(axis, group)
+                self._notify(target, time.time(), group)
+        except Exception as e:
+            if not (self._stop_flag and isinstance(e, magnetException)): # Commands cancelled by the stop hold are expected
+                self.error = e
+                err = traceback.format_exc()
+                print(err)
+                if len(self._IPS_instance.error_list) < 21:
+                    self._IPS_instance.error_list.append(err)
+        finally:
+            if self._stop_flag:
+                try:
+                    axis.hold()
+                except Exception as e:
+                    self.error = e
+            if h5file is not None:
+                h5file.close()
+            with self._condition:
+                self.running = False
+                self._condition.notify_all()
+            self._IPS_instance._emit_event('DONE ' + self.direction + ' ' + repr(time.time()))
+
+    def _sample(self, axis, group):
+        field = axis.read_field(fresh = True)
+        now = time.time()
+        with self._condition:
+            self.times.append(now)
+            self.fields.append(field)
+        if group is not None:
+            append_row(group['time'], now)
+            append_row(group['field'], field)
+            group.file.flush()
+        return field
+
+    def _notify(self, target, now, group):
+        with self._condition:
+            self.reached.append((now, target))
+            self._condition.notify_all()
+        if group is not None:
+            append_row(group['reached_time'], now)
+            append_row(group['reached_field'], target)
+            group.file.flush()
+        for callback in list(self._callbacks):
+            try:
+                callback(self.direction, target, now)
+            except Exception:
+                traceback.print_exc()
+        self._IPS_instance._emit_event('REACHED ' + self.direction + ' ' + repr(target) + ' ' + repr(now))
+
+    # One group per sweep: field_sweeps/<direction>_<start time>
+    def _open_hdf5(self):
+        import h5py
+        h5file = h5py.File(self.hdf5_filename, 'a')
+        group = h5file.require_group('field_sweeps').create_group(self.direction + '_' + time.strftime('%Y%m%d_%H%M%S'))
+        for name in ['time', 'field', 'reached_time', 'reached_field']:
+            group.create_dataset(name, shape = (0,), maxshape = (None,), chunks = (1024,), dtype = 'f8')
+        group.attrs['direction'] = self.direction
+        group.attrs['targets'] = self.targets
+        group.attrs['rate'] = self.rate
+        return h5file, group
+
+def append_row(dataset, value):
+    dataset.resize((dataset.shape[0] + 1,))
+    dataset[-1] = value
+
 class magnetException(Exception):
 
     def __init__(self, message):
@@ -0,0 +1,757 @@
+#Simulated instruments, so the drivers can be run (and benchmarked) without
+#the fridge, the power supplies or a GPIB bus.
+#
+#    from ult_instruments.Python import simulators
+#    sims = simulators.simulate_lab(latency = 0.005, error_rate = 0.01)
+#    from ult_instruments.Python import keithley2400, mercuryIPS, triton_monitor, delta_es150
+#    gate = keithley2400.keithley2400('COM3')
+#    magnet = mercuryIPS.mercuryIPS('COM6')
+#    fridge = triton_monitor.triton_monitor('127.0.0.1', sims['triton'].port)
+#    supply = delta_es150.delta_es150(com_port = 'COM7')
+#
+#install() puts fake 'serial', 'visa' and 'pyvisa' modules in sys.modules
+#(replacing the real ones only with force = True), so it has to run before the
+#drivers are imported; patch(module) swaps them into a driver module that is
+#already imported. Serial ports and VISA resource names are then looked up in
+#serial_devices and visa_resources, which add_serial_device and
+#add_visa_resource (or simulate_lab) fill in.
+#
+#Every simulator takes:
+#    latency    : seconds before each reply is available. A serial readline
+#                 gives up after the port timeout, as on real hardware.
+#    error_rate : probability that a reply is lost (serial read times out, VISA
+#                 raises VisaIOError, Triton closes the socket) or garbled
+#    seed       : for repeatable error injection and noise
+#and counts its transactions and injected errors.
+
+import sys
+import time
+import math
+import types
+import random
+import socket
+import threading
+import traceback
+import numpy as np
+
+class simulatedDevice(object):
+
+    terminator = '\n' # Appended to every reply
+
+    def __init__(self, latency = 0.0, error_rate = 0.0, seed = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.transactions = 0
+        self.errors = 0
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        return type(self).__name__ + '(' + str(self.transactions) + ' transactions, ' + str(self.errors) + ' injected errors)'
+
+    # Answers one message: a reply string, a list of replies, or None.
+    # Strings get the terminator; bytes (binary blocks) are sent as they are.
+    def handle(self, message):
+        raise NotImplementedError
+
+    # Replies to message as (time the reply is ready, reply) pairs, after error injection
+    def respond(self, message):
+        with self.lock:
+            self.transactions += 1
+            replies = self.handle(message)
+        if replies is None:
+            return []
+        if not isinstance(replies, list):
+            replies = [replies]
+        ready = time.time() + self.latency
+        result = []
+        for reply in replies:
+            if isinstance(reply, str):
+                reply = (reply + self.terminator).encode()
+            if self.rng.random() < self.error_rate:
+                self.errors += 1
+                if self.rng.random() < 0.5:
+                    continue # Lost
+                reply = self.garble(reply)
+            result.append((ready, reply))
+        return result
+
+    def garble(self, reply):
+        data = bytearray(reply)
+        body = max(len(data) - len(self.terminator), 1)
+        for _ in range(max(1, body // 8)):
+            data[self.rng.randrange(body)] = self.rng.choice(b'#?!xZ')
+        return bytes(data)
+
+    def noise(self, scale):
+        return self.rng.gauss(0, scale)
+
+# Stands in for serial.Serial, connected to a simulatedDevice
+class fakeSerial(object):
+
+    def __init__(self, port = None, baudrate = 9600, timeout = None, **kwargs):
+        if port not in serial_devices:
+            raise fake_serial.SerialException('could not open port ' + str(port) + ': no simulated device')
+        self.device = serial_devices[port]
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+        self._input = b''
+        self._output = [] # (ready time, bytes)
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        with self._lock:
+            self._input += data
+            lines = self._input.split(b'\n')
+            self._input = lines.pop()
+        for line in lines:
+            replies = self.device.respond(line.decode(errors = 'replace').strip())
+            with self._lock:
+                self._output.extend(replies)
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        now = time.time()
+        with self._lock:
+            return sum(len(reply) for ready, reply in self._output if ready <= now)
+
+    def _take(self, stop):
+        # Bytes that are ready, up to and including the first stop(buffer) position
+        now = time.time()
+        with self._lock:
+            available = b''
+            count = 0
+            for ready, reply in self._output:
+                if ready > now:
+                    break
+                available += reply
+                count += 1
+            end = stop(available)
+            if end is None:
+                return None
+            taken, rest = available[:end], available[end:]
+            self._output = ([(now, rest)] if rest else []) + self._output[count:]
+            return taken
+
+    def _read(self, stop, partial):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while True:
+            data = self._take(stop)
+            if data is not None:
+                return data
+            if (deadline is not None) and (time.time() >= deadline):
+                return self._take(partial) or b''
+            time.sleep(0.0005)
+
+    def read(self, size = 1):
+        return self._read(lambda buf: size if len(buf) >= size else None, lambda buf: len(buf))
+
+    def read_until(self, expected = b'\n', size = None):
+        if isinstance(expected, str):
+            expected = expected.encode()
+        def stop(buf):
+            index = buf.find(expected)
+            if index >= 0:
+                end = index + len(expected)
+                return end if size is None else min(end, size)
+            if (size is not None) and (len(buf) >= size):
+                return size
+            return None
+        return self._read(stop, lambda buf: len(buf))
+
+    def readline(self):
+        return self.read_until(b'\n')
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._output = []
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+class fakeVisaIOError(Exception):
+    def __init__(self, error_code = -1073807339, description = 'VI_ERROR_TMO (-1073807339): Timeout expired before operation completed.'):
+        super(fakeVisaIOError, self).__init__(description)
+        self.error_code = error_code
+
+# Stands in for a pyvisa resource
+class fakeResource(object):
+
+    def __init__(self, resource_name, device):
+        self.resource_name = resource_name
+        self.device = device
+        self.timeout = 2000 # ms
+        self._output = []
+
+    def write(self, message):
+        self._output.extend(self.device.respond(message.strip()))
+
+    def _next(self):
+        deadline = time.time() + self.timeout / 1000.0
+        while not self._output:
+            if time.time() >= deadline:
+                raise fakeVisaIOError()
+            time.sleep(0.0005) # A reply delayed by a concurrent write
+        ready, reply = self._output.pop(0)
+        delay = ready - time.time()
+        if delay > self.timeout / 1000.0:
+            time.sleep(self.timeout / 1000.0)
+            raise fakeVisaIOError()
+        if delay > 0:
+            time.sleep(delay)
+        return reply
+
+    def read_raw(self):
+        return self._next()
+
+    def read(self):
+        return self._next().decode(errors = 'replace')
+
+    def read_bytes(self, count):
+        data = b''
+        while len(data) < count:
+            data += self._next()
+        return data[:count]
+
+    def query(self, message):
+        self._output = []
+        self.write(message)
+        return self.read()
+
+    def read_stb(self):
+        return self.device.read_stb()
+
+    def enable_event(self, event_type, mechanism, context = None):
+        pass
+
+    def disable_event(self, event_type, mechanism):
+        pass
+
+    def discard_events(self, event_type, mechanism):
+        pass
+
+    # Returns once the device asserts SRQ; like VISA, leaves the status byte alone
+    def wait_on_event(self, event_type, timeout):
+        deadline = time.time() + (timeout or 0) / 1000.0
+        while not self.device.srq():
+            if time.time() >= deadline:
+                raise fakeVisaIOError()
+            time.sleep(0.001)
+
+    # Like pyvisa's, serial polls the device itself, which clears the status byte
+    def wait_for_srq(self, timeout = 25000):
+        self.wait_on_event(fake_visa_constants.EventType.service_request, timeout)
+        self.device.read_stb()
+
+    def control_ren(self, mode):
+        pass
+
+    def clear(self):
+        self._output = []
+
+    def close(self):
+        pass
+
+class fakeResourceManager(object):
+
+    def __init__(self, *args):
+        pass
+
+    def list_resources(self, query = '?*::INSTR'):
+        return tuple(visa_resources.keys())
+
+    def open_resource(self, resource_name, **kwargs):
+        if resource_name not in visa_resources:
+            raise fakeVisaIOError(-1073807343, 'VI_ERROR_RSRC_NFOUND: Insufficient location information or the requested device or resource is not present in the system.')
+        return fakeResource(resource_name, visa_resources[resource_name])
+
+    def close(self):
+        pass
+
+class fakeSerialException(IOError):
+    pass
+
+fake_serial = types.ModuleType('serial')
+fake_serial.Serial = fakeSerial
+fake_serial.SerialException = fakeSerialException
+fake_serial.SerialTimeoutException = fakeSerialException
+
+fake_visa_constants = types.ModuleType('pyvisa.constants')
+fake_visa_constants.EventType = types.SimpleNamespace(service_request = 1073684491)
+fake_visa_constants.EventMechanism = types.SimpleNamespace(queue = 1)
+
+fake_visa = types.ModuleType('pyvisa')
+fake_visa.ResourceManager = fakeResourceManager
+fake_visa.VisaIOError = fakeVisaIOError
+fake_visa.constants = fake_visa_constants
+fake_visa.errors = types.ModuleType('pyvisa.errors')
+fake_visa.errors.VisaIOError = fakeVisaIOError
+
+serial_devices = {} # port : simulatedDevice
+visa_resources = {} # resource name : simulatedDevice
+
+def add_serial_device(port, device):
+    serial_devices[port] = device
+    return device
+
+def add_visa_resource(resource_name, device):
+    visa_resources[resource_name] = device
+    return device
+
+# Makes 'import serial', 'import visa' and 'import pyvisa' give the fakes.
+# Without force, real modules that are already importable are kept.
+def install(force = False):
+    for name, module in [('serial', fake_serial), ('visa', fake_visa), ('pyvisa', fake_visa)]:
+        if force or (name not in sys.modules and not _importable(name)):
+            sys.modules[name] = module
+
+def _importable(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+# Points an already imported driver module at the fakes
+def patch(*modules):
+    for module in modules:
+        if hasattr(module, 'serial'):
+            module.serial = fake_serial
+        if hasattr(module, 'visa'):
+            module.visa = fake_visa
+
+#Keithley 2400 SourceMeter (keithley2400), sourcing voltage into a resistive load
+class keithley2400Simulator(simulatedDevice):
+
+    def __init__(self, load_resistance = 1e9, **kwargs):
+        super(keithley2400Simulator, self).__init__(**kwargs)
+        self.load_resistance = load_resistance
+        self.voltage = 0.0
+        self.output = False
+        self.start_time = time.time()
+
+    def handle(self, message):
+        command = message.upper()
+        if command.startswith(':SOUR:VOLT:LEV'):
+            self.voltage = float(message.split()[-1])
+        elif command.startswith('OUTPUT'):
+            self.output = command.endswith('ON')
+        elif command.startswith(':READ?'):
+            voltage = self.voltage if self.output else 0.0
+            current = voltage / self.load_resistance + self.noise(1e-12)
+            values = [voltage, current, 9.91e37, time.time() - self.start_time, 21504]
+            return ','.join('%+.6E' % value for value in values)
+        return None
+
+#Mercury iPS magnet power supply (mercuryIPS), with X, Y and Z axes that ramp
+#at their set rate (T/min) while the action is RTOS or RTOZ
+class mercuryIPSSimulator(simulatedDevice):
+
+    def __init__(self, amps_per_tesla = 10.0, **kwargs):
+        super(mercuryIPSSimulator, self).__init__(**kwargs)
+        self.amps_per_tesla = amps_per_tesla
+        self.axes = {}
+        for direction in ['X', 'Y', 'Z']:
+            self.axes[direction] = {'field': 0.0, 'target': 0.0, 'rate': 0.1, 'action': 'HOLD',
+                                    'switch_heater': 'ON', 'persistent': 0.0, 'time': time.time()}
+
+    def _update(self, axis):
+        now = time.time()
+        target = {'RTOS': axis['target'], 'RTOZ': 0.0}.get(axis['action'])
+        if target is not None:
+            step = axis['rate'] / 60.0 * (now - axis['time'])
+            if abs(target - axis['field']) <= step:
+                axis['field'] = target
+            else:
+                axis['field'] += math.copysign(step, target - axis['field'])
+            if axis['switch_heater'] == 'ON':
+                axis['persistent'] = axis['field']
+        axis['time'] = now
+
+    def handle(self, message):
+        parts = message.strip().split(':')
+        if (len(parts) < 5) or (parts[0] not in ['READ', 'SET']) or not parts[2].startswith('GRP'):
+            return 'STAT:' + message.strip() + ':INVALID'
+        axis = self.axes.get(parts[2][3:])
+        if axis is None:
+            return 'STAT:' + message.strip() + ':INVALID'
+        self._update(axis)
+        item = ':'.join(parts[4:]).rstrip('?')
+        if parts[0] == 'READ':
+            values = {'SIG:FLD': '%.4fT' % axis['field'],
+                      'SIG:PFLD': '%.4fT' % axis['persistent'],
+                      'SIG:CURR': '%.4fA' % (axis['field'] * self.amps_per_tesla),
+                      'SIG:VOLT': '%.4fV' % (self.noise(1e-4) + (0.2 if axis['field'] != axis['target'] and axis['action'] != 'HOLD' else 0)),
+                      'SIG:FSET': '%.4fT' % axis['target'],
+                      'SIG:RFST': '%.4fT/m' % axis['rate'],
+                      'SIG:SWHT': axis['switch_heater'],
+                      'ACTN': axis['action']}
+            value = values.get(item)
+            return 'STAT:' + ':'.join(parts[1:4]) + ':' + item + ':' + (value if value is not None else 'INVALID')
+        valid = 'VALID'
+        if parts[4] == 'ACTN' and len(parts) > 5 and parts[5] in ['HOLD', 'RTOS', 'RTOZ', 'CLMP']:
+            axis['action'] = parts[5]
+        elif item.startswith('SIG:SWHT:'):
+            axis['switch_heater'] = parts[6]
+        elif item.startswith('SIG:FSET:'):
+            axis['target'] = float(parts[6].rstrip('T'))
+        elif item.startswith('SIG:RFST:'):
+            axis['rate'] = float(parts[6].split('T')[0])
+        else:
+            valid = 'INVALID'
+        return 'STAT:' + message.strip() + ':' + valid
+
+#Delta Elektronika ES150 power supply (delta_es150) through a PSC-232
+#module, which ends every reply with EOT
+class deltaES150Simulator(simulatedDevice):
+
+    terminator = '\r\n\x04'
+
+    def __init__(self, max_voltage = 30.0, max_current = 5.0, load_resistance = 10.0, **kwargs):
+        super(deltaES150Simulator, self).__init__(**kwargs)
+        self.max_voltage = max_voltage
+        self.max_current = max_current
+        self.load_resistance = load_resistance
+        self.voltage = 0.0
+        self.current = 0.0
+
+    def handle(self, message):
+        command = message.upper()
+        if command == 'SO:VO:MAX?':
+            return '%.4f' % self.max_voltage
+        if command == 'SO:CU:MAX?':
+            return '%.4f' % self.max_current
+        if command == 'SO:VO?':
+            return '%.4f' % self.voltage
+        if command == 'SO:CU?':
+            return '%.4f' % self.current
+        # Constant voltage until the load would draw more than the current setpoint
+        voltage = min(self.voltage, self.current * self.load_resistance)
+        if command == 'ME:VO?':
+            return '%.4f' % (voltage + self.noise(1e-4))
+        if command == 'ME:CU?':
+            return '%.4f' % (voltage / self.load_resistance + self.noise(1e-5))
+        if command.startswith('SOUR:VOLT') or command.startswith('SO:VO '):
+            self.voltage = float(message.split()[-1])
+        elif command.startswith('SOUR:CURR') or command.startswith('SO:CU '):
+            self.current = float(message.split()[-1])
+        return None
+
+#SR830 lock-in amplifier (sr830_lockin.lockin), measuring a signal of
+#signal_amplitude V at signal_phase degrees. The data buffer fills at the
+#sample rate from STRT until PAUS or (with SEND 0) until it is full.
+class lockinSimulator(simulatedDevice):
+
+    def __init__(self, signal_amplitude = 1e-3, signal_phase = 30.0, noise_level = 1e-6, **kwargs):
+        super(lockinSimulator, self).__init__(**kwargs)
+        self.signal_amplitude = signal_amplitude
+        self.signal_phase = signal_phase
+        self.noise_level = noise_level
+        self.settings = {'SLVL': 0.004, 'FREQ': 1000.0, 'HARM': 1, 'PHAS': 0.0, 'OFLT': 10, 'SENS': 22,
+                         'ISRC': 0, 'OFSL': 1, 'SRAT': 4, 'SEND': 1, 'RMOD': 1, 'ICPL': 0, 'IGND': 0}
+        self.ddef = {1: [0, 0], 2: [0, 0]}
+        self.oexp = {1: [0.0, 0], 2: [0.0, 0], 3: [0.0, 0]}
+        self.buffer_start = None
+        self.buffer_points = 0
+
+    def _xy(self):
+        phase = math.radians(self.signal_phase - self.settings['PHAS'])
+        x = self.signal_amplitude * math.cos(phase) + self.noise(self.noise_level)
+        y = self.signal_amplitude * math.sin(phase) + self.noise(self.noise_level)
+        return x, y
+
+    def _output(self, code):
+        x, y = self._xy()
+        values = {1: x, 2: y, 3: math.hypot(x, y), 4: math.degrees(math.atan2(y, x)),
+                  5: 0.0, 6: 0.0, 7: 0.0, 8: 0.0, 9: self.settings['FREQ']}
+        # CH1 and CH2 show X, R, X noise, AUX1, AUX2 and Y, THETA, Y noise, AUX3, AUX4
+        for channel, codes in [(1, [1, 3, None, 5, 6]), (2, [2, 4, None, 7, 8])]:
+            shown = codes[self.ddef[channel][0]]
+            values[9 + channel] = self.noise_level if shown is None else values[shown]
+        return values[code]
+
+    def _buffer_size(self):
+        if self.buffer_start is None:
+            return self.buffer_points
+        if self.settings['SRAT'] >= 14: # Triggered
+            return self.buffer_points
+        rate = 0.0625 * 2 ** self.settings['SRAT']
+        return min(self.buffer_points + int((time.time() - self.buffer_start) * rate), 16383)
+
+    def _trace(self, channel, count):
+        return np.array([self._output(9 + channel) for _ in range(count)])
+
+    def handle(self, message):
+        replies = []
+        for command in message.split(';'):
+            reply = self._command(command.strip())
+            if reply is not None:
+                replies.append(reply)
+        return replies
+
+    def _command(self, command):
+        if not command:
+            return None
+        query = '?' in command
+        name = command.replace('?', ' ').split()[0].upper()
+        arguments = [argument.strip() for argument in command.replace('?', ' ')[len(name):].replace(' ', '').split(',') if argument.strip()]
+        if name in self.settings:
+            if query:
+                value = self.settings[name]
+                return ('%.6g' % value) if isinstance(value, float) else str(value)
+            self.settings[name] = type(self.settings[name])(float(arguments[0]))
+            if name == 'PHAS':
+                phase = self.settings['PHAS'] % 360
+                self.settings['PHAS'] = phase - 360 if phase > 180 else phase
+            return None
+        if name == 'SNAP':
+            return ','.join('%.6e' % self._output(int(code)) for code in arguments)
+        if name == 'OUTP':
+            return '%.6e' % self._output(int(arguments[0]))
+        if name == 'LIAS':
+            return '0'
+        if name == 'DDEF':
+            channel = int(arguments[0])
+            if query:
+                return ','.join(str(value) for value in self.ddef[channel])
+            self.ddef[channel] = [int(arguments[1]), int(arguments[2])]
+            return None
+        if name == 'OEXP':
+            channel = int(arguments[0])
+            if query:
+                return '%.2f,%d' % tuple(self.oexp[channel])
+            self.oexp[channel] = [float(arguments[1]), int(arguments[2])]
+            return None
+        if name == 'APHS':
+            self.settings['PHAS'] = round(self.signal_phase, 2)
+            return None
+        if name == 'REST':
+            self.buffer_start = None
+            self.buffer_points = 0
+            return None
+        if name == 'STRT':
+            self.buffer_start = time.time()
+            return None
+        if name == 'PAUS':
+            self.buffer_points = self._buffer_size()
+            self.buffer_start = None
+            return None
+        if name == 'SPTS':
+            return str(self._buffer_size())
+        if name in ['TRCB', 'TRCL']:
+            channel, start, count = [int(argument) for argument in arguments]
+            values = self._trace(channel, count)
+            if name == 'TRCB':
+                return values.astype('<f4').tobytes()
+            mantissa, exponent = np.frexp(values)
+            words = np.zeros((count, 2), dtype = '<i2')
+            words[:, 0] = np.round(mantissa * 2 ** 14)
+            words[:, 1] = np.where(values == 0, 0, exponent + 110)
+            return words.tobytes()
+        if name in ['AGAN', 'ARSV', 'AOFF', 'TRIG', '*CLS', '*RST']:
+            return None
+        if name == '*IDN':
+            return 'Stanford_Research_Systems,SR830,s/n00000,ver1.07 (simulated)'
+        return None
+
+#KEPCO BHK 2000-0.1MG high voltage supply (kepco)
+class kepcoSimulator(simulatedDevice):
+
+    def __init__(self, voltage = 0.0, load_resistance = 1e8, **kwargs):
+        super(kepcoSimulator, self).__init__(**kwargs)
+        self.voltage = voltage
+        self.load_resistance = load_resistance
+
+    def handle(self, message):
+        command = message.upper()
+        if command.startswith('MEAS:SCAL:VOLT?') or command.startswith('MEAS:VOLT?'):
+            return '%.5E' % (self.voltage + self.noise(1e-3))
+        if command.startswith('MEAS:SCAL:CURR?') or command.startswith('MEAS:CURR?'):
+            return '%.5E' % (self.voltage / self.load_resistance + self.noise(1e-9))
+        if command.startswith('VOLT '):
+            self.voltage = float(message.split()[-1])
+        return None
+
+#HP 3562A dynamic signal analyzer (hp3562a.SpectrumAnalyzer). A measurement
+#started with STRT takes measurement_time s per average; the spectrum is a
+#noise floor with a few vibration peaks. With RQS set, the status byte
+#requests service when it is done.
+class spectrumAnalyzerSimulator(simulatedDevice):
+
+    terminator = '\r\n'
+
+    def __init__(self, measurement_time = 0.2, points = 401, peaks = ((60.0, 1e-3), (120.0, 3e-4)), **kwargs):
+        super(spectrumAnalyzerSimulator, self).__init__(**kwargs)
+        self.measurement_time = measurement_time
+        self.points = points
+        self.peaks = peaks
+        self.span = 400.0
+        self.averages = 1
+        self.rqs_mask = 0
+        self.status_byte = 0
+        self.done_time = None
+        self.done_reported = False
+
+    def _done(self):
+        return (self.done_time is not None) and (time.time() >= self.done_time)
+
+    # Sets the measurement done bit (4) once per measurement, and RQS (64)
+    # while any bit enabled by RQS is set
+    def srq(self):
+        if self._done() and not self.done_reported:
+            self.status_byte |= 4
+            self.done_reported = True
+        if self.status_byte & self.rqs_mask & ~64:
+            self.status_byte |= 64
+        return bool(self.status_byte & 64)
+
+    def read_stb(self):
+        self.srq()
+        status, self.status_byte = self.status_byte, 0
+        return status
+
+    def spectrum(self):
+        frequency = np.linspace(0, self.span, self.points)
+        values = 1e-6 * (1 + np.abs(np.array([self.noise(1) for _ in frequency]))) / np.sqrt(self.averages)
+        for center, height in self.peaks:
+            values += height / (1 + ((frequency - center) / (self.span / self.points)) ** 2)
+        return values
+
+    def handle(self, message):
+        command = message.strip().rstrip(';').upper()
+        if command == 'STRT':
+            self.done_time = time.time() + self.measurement_time * self.averages
+            self.done_reported = False
+            self.status_byte = 0
+        elif command == 'SMSD':
+            return '1' if self._done() else '0'
+        elif command.startswith('RQS'):
+            self.rqs_mask = int(command.split()[-1])
+        elif command.startswith('FRS'):
+            self.span = float(command.split(',')[-1].rstrip('HZ'))
+        elif command.startswith('NAVG'):
+            self.averages = max(int(command.split()[-1]), 1)
+        elif command == 'DDAS':
+            header = [0.0] * 67
+            header[1] = self.points
+            return '#I' + '\r\n'.join('%.6E' % value for value in header + list(self.spectrum()))
+        elif command == 'DDBN':
+            return self._binary_dump(self.spectrum())
+        return None
+
+    # Header with the entries hp3562a.parse_binary_header reads: the leading
+    # integers, delta x and the start frequency
+    def _binary_dump(self, values):
+        header = np.zeros(84, dtype = '>i2')
+        header[:4] = [0, len(values), len(values), self.averages]
+        header = bytearray(header.tobytes())
+        header[116:120] = self._hp_float([self.span / (len(values) - 1)])
+        header[152:160] = self._hp_float([0.0], 8)
+        body = bytes(header) + self._hp_float(values)
+        return b'#A' + np.array([len(body)], dtype = '>u2').tobytes() + body
+
+    @staticmethod
+    def _hp_float(values, size = 4):
+        mantissa, exponent = np.frexp(np.asarray(values, dtype = float))
+        bits = 8 * size - 9
+        words = np.round(mantissa * 2 ** bits).astype(np.int64)
+        overflow = words >= 2 ** bits
+        words[overflow] //= 2
+        exponent[overflow] += 1
+        return ((words << 8) | (exponent.astype(np.int64) & 0xFF)).astype('>i' + str(size)).tobytes()
+
+#Triton dilution refrigerator system control (triton_monitor), as a TCP
+#server answering one READ:DEV:<T or P channel>:... message per connection
+class tritonSimulator(simulatedDevice):
+
+    def __init__(self, host = '127.0.0.1', port = 0, **kwargs):
+        super(tritonSimulator, self).__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self.temperatures = {'T1': 4.2, 'T2': 1.5, 'T3': 0.8, 'T4': 0.1, 'T5': 0.012,
+                             'T6': 0.015, 'T7': 0.016, 'T8': 2.0}
+        self.pressures = {'P1': 5.2e2, 'P2': 1.1e2, 'P3': 2.0e-2, 'P4': 1.5, 'P5': 3.0e-3}
+        self.drift = 0.002 # Relative noise of each reading
+        self.error_list = []
+        self._socket = None
+        self._running = False
+
+    def start(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((self.host, self.port))
+        s.listen(16)
+        self.port = s.getsockname()[1]
+        self._socket = s
+        self._running = True
+        worker = threading.Thread(target = self._serve)
+        worker.daemon = True
+        worker.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._socket is not None:
+            self._socket.close()
+
+    def _serve(self):
+        while self._running:
+            try:
+                conn, _ = self._socket.accept()
+            except (socket.error, OSError):
+                break
+            worker = threading.Thread(target = self._reply, args = (conn,))
+            worker.daemon = True
+            worker.start()
+
+    def _reply(self, conn):
+        try:
+            message = conn.recv(4096).decode().strip()
+            replies = self.respond(message)
+            for ready, reply in replies:
+                delay = ready - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                conn.sendall(reply)
+        except Exception:
+            self.error_list.append(traceback.format_exc())
+        finally:
+            conn.close()
+
+    def handle(self, message):
+        parts = message.split(':')
+        if (len(parts) < 4) or (parts[0] != 'READ'):
+            return 'STAT:' + message + ':INVALID'
+        channel = parts[2]
+        if channel in self.temperatures and message.endswith('TEMP'):
+            value = self.temperatures[channel] * (1 + self.noise(self.drift))
+            return 'STAT:' + message[len('READ:'):] + ':' + '%.6g' % value + 'K'
+        if channel in self.pressures and message.endswith('PRES'):
+            value = self.pressures[channel] * (1 + self.noise(self.drift))
+            return 'STAT:' + message[len('READ:'):] + ':' + '%.6g' % value + 'mB'
+        return 'STAT:' + message[len('READ:'):] + ':NOT_FOUND'
+
+# Sets up a simulator for every driver on its default port or address, except
+# the delta_es150, whose default COM6 is taken by the mercuryIPS: it sits on
+# COM7, so open it with com_port = 'COM7'. Also installs the fake serial and
+# VISA modules. Returns the simulators by name; the Triton server listens on
+# sims['triton'].port.
+def simulate_lab(latency = 0.0, error_rate = 0.0, seed = None, force = False):
+    install(force)
+    options = {'latency': latency, 'error_rate': error_rate, 'seed': seed}
+    sims = {'keithley2400': add_serial_device('COM3', keithley2400Simulator(**options)),
+            'mercuryIPS': add_serial_device('COM6', mercuryIPSSimulator(**options)),
+            'delta_es150': add_serial_device('COM7', deltaES150Simulator(**options)),
+            'lockin': add_visa_resource('GPIB0::8::INSTR', lockinSimulator(**options)),
+            'SpectrumAnalyzer': add_visa_resource('GPIB0::7::INSTR', spectrumAnalyzerSimulator(**options)),
+            'kepco': add_visa_resource('GPIB1::6::INSTR', kepcoSimulator(**options)),
+            'triton': tritonSimulator(**options).start()}
+    return sims
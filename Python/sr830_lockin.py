@@ -10,13 +10,22 @@
 #autogain()
 #set_timeconstant()
 #get_timeconstant()
+#set_timeconstant_seconds(FLOAT), get_timeconstant_seconds()
 #set_sensitivity()
 #get_sensitivity()
+#set_sensitivity_volts(FLOAT), get_sensitivity_volts()
+#set_sensitivity_for_signal(FLOAT)
+#autorange()
+#get_settling_time()
+#snap(PARAM, PARAM, ...)
+#refresh_settings(), check_settings(), invalidate_settings()
+#set_display(INT, STRING), get_display(INT)
+#set_sample_rate(FLOAT), get_sample_rate()
+#reset_buffer(), start_buffer(), pause_buffer(), get_buffer_size()
+#read_buffer(INT)
+#acquire_buffer(INT)
 
 #NOT IMPLEMENTED YET:
-# self.read/write("DDEF(?) i,{j,k}") where i=1 for channel 1 & i=2 for channel 2
-#                                   where j=0 for X/Y & j=1 for R/THETA
-#                                   and k=0
 # FPOP for display vs X/Y
 # If a bad read command is sent, lock-in may send junk back in following
 # n queries. Need to implement a way to clear read buffer before each
@@ -31,22 +40,161 @@ import time
 import traceback
 import socket
 import ast
+import numpy as np
 
 try:
     import thread
 except ModuleNotFoundError:
     import _thread as thread
 
+try:
+    from . import data_bus
+except ImportError: # Imported as a plain module rather than from the package
+    import data_bus
+
 try:
     long
 except NameError:
     long = int
 
+# Parameter codes accepted by SNAP?
+snap_parameters = {
+    'X' : 1,
+    'Y' : 2,
+    'R' : 3,
+    'THETA' : 4,
+    'AUX1' : 5,
+    'AUX2' : 6,
+    'AUX3' : 7,
+    'AUX4' : 8,
+    'FREQ' : 9,
+    'CH1' : 10,
+    'CH2' : 11 }
+snap_names = dict((code, name) for name, code in snap_parameters.items())
+
+# Units of the SNAP? parameters, for readings published to a data bus
+# (CH1 and CH2 depend on what the displays show)
+snap_units = {
+    'X' : 'V',
+    'Y' : 'V',
+    'R' : 'V',
+    'THETA' : 'deg',
+    'AUX1' : 'V',
+    'AUX2' : 'V',
+    'AUX3' : 'V',
+    'AUX4' : 'V',
+    'FREQ' : 'Hz' }
+
+# Quantities shown on the CH1/CH2 displays, as set by DDEF.
+# The data buffer stores whatever the displays show.
+display_quantities = {
+    1 : ['X', 'R', 'XN', 'AUX1', 'AUX2'],
+    2 : ['Y', 'THETA', 'YN', 'AUX3', 'AUX4'] }
+
+# Data buffer sample rates (Hz) indexed by the SRAT code.
+# SRAT 14 samples on external trigger instead.
+sample_rates = 0.0625 * 2.0 ** np.arange(14)
+
+# Number of points the data buffer holds per channel
+buffer_length = 16383
+
+# Time constants (s) indexed by the OFLT code, 10us to 30ks
+time_constants = np.array([mantissa * 10.0 ** exponent for exponent in range(-5, 5) for mantissa in (1, 3)])
+time_constant_labels = ['10us', '30us', '100us', '300us', '1ms', '3ms', '10ms', '30ms', '100ms', '300ms',
+                        '1s', '3s', '10s', '30s', '100s', '300s', '1ks', '3ks', '10ks', '30ks']
+
+# Sensitivities (V full scale) indexed by the SENS code, 2nV to 1V
+sensitivities = np.array([mantissa * 10.0 ** exponent for exponent in range(-9, 0) for mantissa in (2, 5, 10)])
+sensitivity_labels = ['2nV', '5nV', '10nV', '20nV', '50nV', '100nV', '200nV', '500nV',
+                      '1uV', '2uV', '5uV', '10uV', '20uV', '50uV', '100uV', '200uV', '500uV',
+                      '1mV', '2mV', '5mV', '10mV', '20mV', '50mV', '100mV', '200mV', '500mV', '1V']
+
+# Index into a sorted table for value (scalar or array).
+# mode = 'nearest' (on a log scale), 'ceil' (smallest entry >= value)
+# or 'floor' (largest entry <= value). Out of range values are clipped.
+def table_index(table, value, mode = 'nearest'):
+    value = np.abs(np.asarray(value, dtype = float))
+    if mode == 'nearest':
+        value = np.clip(value, table[0], table[-1])
+        index = np.clip(np.searchsorted(table, value), 1, len(table) - 1)
+        lower_closer = np.log(value / table[index - 1]) < np.log(table[index] / value)
+        index = np.where(lower_closer, index - 1, index)
+    elif mode == 'ceil':
+        index = np.searchsorted(table, value * (1 - 1e-9), side = 'left')
+    elif mode == 'floor':
+        index = np.searchsorted(table, value * (1 + 1e-9), side = 'right') - 1
+    else:
+        raise ValueError("mode must be 'nearest', 'ceil' or 'floor'")
+    return np.clip(index, 0, len(table) - 1)
+
+def timeconstant_index(seconds, mode = 'nearest'):
+    return table_index(time_constants, seconds, mode)
+
+def sensitivity_index(volts, mode = 'nearest'):
+    return table_index(sensitivities, volts, mode)
+
+# Smallest sensitivity index whose full scale keeps amplitude (V) below headroom * full scale
+def sensitivity_for_signal(amplitude, headroom = 1.0):
+    return sensitivity_index(np.abs(amplitude) / headroom, 'ceil')
+
+# Converts an index or a label (e.g. '1ms') into an index, or None if invalid
+def parse_table_index(value, labels):
+    if isinstance(value, str):
+        if value in labels:
+            return labels.index(value)
+        try:
+            value = int(value)
+        except ValueError:
+            return None
+    try:
+        index = int(value)
+    except (TypeError, ValueError):
+        return None
+    if 0 <= index < len(labels):
+        return index
+    return None
+
+# Prints a two column menu of labels
+def print_table(labels):
+    half = (len(labels) + 1) // 2
+    for left in range(half):
+        line = '{:<2} : {:<9}'.format(left, labels[left])
+        if left + half < len(labels):
+            line += '{:<2} : {}'.format(left + half, labels[left + half])
+        print(line)
+
+# Settings that only change when we set them (or from the front panel,
+# AGAN and APHS), so lockin caches them. Name : (query, parser)
+# The lock-in may coerce HARM (harmonic * frequency <= 102 kHz, also when
+# FREQ is raised) and OFLT (limited by reserve, slope and frequency), so
+# those are read again on the next get_ rather than cached as requested.
+cached_settings = {
+    'timeconstant' : ('OFLT ?', int),
+    'sensitivity' : ('SENS ?', int),
+    'harmonic' : ('HARM ?', int),
+    'input' : ('ISRC ?', int),
+    'phase' : ('PHAS ?', float),
+    'slope' : ('OFSL ?', int) }
+
+# Time constants needed to settle to 99% for the 6, 12, 18 and 24 dB/oct
+# filter slopes (OFSL 0-3)
+settling_timeconstants = [5, 7, 9, 10]
+
+# LIAS? bits for input, time constant filter and output overloads
+overload_mask = 0b111
+
 class lockin:
 
     #The primary address is assumed to be 8
-    def __init__(self, address = 8, gpib_num = 0, start_listening = True):
+    def __init__(self, address = 8, gpib_num = 0, start_listening = True, bus = None):
         self.primary_id = 'GPIB' + str(gpib_num) + '::' +str(address) +'::INSTR'
+        self.bus = bus # Optional data_bus.dataBus
+        self.bus_source = 'lockin'
+        self._settings = {}
+        try:
+            self.refresh_settings()
+        except Exception:
+            print('WARNING: Could not read lock-in settings. They will be read on first use.')
         if start_listening:
             self.start_listen()
 
@@ -67,6 +215,59 @@ class lockin:
         rm.close()
         return answer
 
+    # Sends several queries on one line and returns one answer per query
+    def read_batch(self, *messages):
+        answers = []
+        rm = visa.ResourceManager()
+        if self.primary_id in rm.list_resources():
+            inst = rm.open_resource(self.primary_id)
+            inst.write(';'.join(messages))
+            while len(answers) < len(messages):
+                answers += inst.read().replace(';', ' ').split()
+            inst.close()
+        rm.close()
+        return answers
+
+    # Reads every cached setting from the instrument in one transaction
+    def refresh_settings(self):
+        names = list(cached_settings)
+        answers = self.read_batch(*[cached_settings[name][0] for name in names])
+        self._settings = dict((name, cached_settings[name][1](answer)) for name, answer in zip(names, answers))
+        for name in names:
+            data_bus.publish(self.bus, self.bus_source, name, self._settings[name])
+
+    # Re-reads the cached settings and returns the names of those that
+    # changed behind our back (e.g. from the front panel)
+    def check_settings(self):
+        old_settings = self._settings
+        self.refresh_settings()
+        return [name for name in cached_settings if old_settings.get(name) != self._settings.get(name)]
+
+    # Forgets cached settings (all of them if no names are given) so the
+    # next get_ reads them from the instrument
+    def invalidate_settings(self, *names):
+        if len(names) == 0:
+            names = list(cached_settings)
+        for name in names:
+            self._settings.pop(name, None)
+
+    def _get_setting(self, name):
+        if name not in self._settings:
+            query, parser = cached_settings[name]
+            self._settings[name] = data_bus.publish(self.bus, self.bus_source, name, parser(self.read(query)))
+        return self._settings[name]
+
+    # Binary replies (TRCB, TRCL) have no terminator, so read a fixed byte count
+    def read_binary(self, message, nbytes):
+        rm = visa.ResourceManager()
+        if self.primary_id in rm.list_resources():
+            inst = rm.open_resource(self.primary_id)
+            inst.write(message)
+            answer = inst.read_bytes(nbytes)
+            inst.close()
+        rm.close()
+        return answer
+
     #Sets amplitude
     def set_amplitude(self, ampl):
         if 0 <= ampl <= 0.005:
@@ -78,18 +279,19 @@ class lockin:
 
     #Gets amplitude
     def get_amplitude(self):
-        return float(self.read('SLVL ?'))
+        return data_bus.publish(self.bus, self.bus_source, 'amplitude', float(self.read('SLVL ?')), 'V')
 
     #Sets frequency
     def set_frequency(self, freq):
         if 0.001 < freq <= 102000:
             self.write('FREQ ' + str(freq))
+            self.invalidate_settings('harmonic', 'timeconstant')
         else:
             print('ERROR: Frequency out of bounds.')
 
     #Gets frequency
     def get_frequency(self):
-        return float(self.read('FREQ ?'))
+        return data_bus.publish(self.bus, self.bus_source, 'frequency', float(self.read('FREQ ?')), 'Hz')
 
     #Sets harmonic
     def set_harmonic(self, harm):
@@ -101,6 +303,7 @@ class lockin:
         if isinstance(harm,int):
             if 1 <= harm <= 19999:
                 self.write('HARM ' + str(harm))
+                self.invalidate_settings('harmonic')
             else:
                 print('ERROR: Harmonic out of bounds.')
         else:
@@ -108,22 +311,26 @@ class lockin:
 
     #Gets harmonic
     def get_harmonic(self):
-        return int(self.read('HARM ?'))
+        return self._get_setting('harmonic')
 
     #Set phase
     def set_phase(self, phase):
         if -360 <= phase <= 729.99:
             self.write('PHAS ' + str(phase))
+            # The lock-in wraps the phase into (-180, 180]
+            phase = phase % 360
+            self._settings['phase'] = float(phase - 360 if phase > 180 else phase)
         else:
             print('ERROR: Phase out of bounds.')
 
     #Gets phase
     def get_phase(self):
-        return float(self.read('PHAS ?'))
+        return self._get_setting('phase')
 
     #Autophase
     def autophase(self):
         self.write('APHS')
+        self.invalidate_settings('phase')
 
     #Add to phase
     def add_to_phase(self, add):
@@ -134,153 +341,252 @@ class lockin:
     #Autogain
     def autogain(self):
         self.write('AGAN')
+        self.invalidate_settings('sensitivity')
 
     #Set time constant
+    #value is the OFLT index 0-19 or a label such as '300ms'
     def set_timeconstant(self, value = None):
-        rm = visa.ResourceManager()
-        if self.primary_id in rm.list_resources():
-            if value is None:
-                print('SELECT TIME CONSTANT')
-                print('0 : 10us       10 : 1s')
-                print('1 : 30us       11 : 3s')
-                print('2 : 100us      12 : 10s')
-                print('3 : 300us      13 : 30s')
-                print('4 : 1ms        14 : 100s')
-                print('5 : 3ms        15 : 300s')
-                print('6 : 10ms       16 : 1ks')
-                print('7 : 30ms       17 : 3ks')
-                print('8 : 100ms      18 : 10ks')
-                print('9 : 300ms      19 : 30ks')
-                time_set = ast.literal_eval(input())
-            else:
-                try:
-                    time_set = int(value)
-                except ValueError:
-                    print("ERROR: Not an integer")
-            if isinstance(time_set,int) and (0 <= time_set <= 19):
-                inst = rm.open_resource(self.primary_id)
-                inst.write('OFLT ' + str(time_set))
-                inst.close()
-            else:
-                print("Invalid Input: Must be integer between 0 and 19")
-        rm.close
+        if value is None:
+            print('SELECT TIME CONSTANT')
+            print_table(time_constant_labels)
+            value = ast.literal_eval(input())
+        time_set = parse_table_index(value, time_constant_labels)
+        if time_set is None:
+            print("Invalid Input: Must be integer between 0 and 19")
+            return
+        self.write('OFLT ' + str(time_set))
+        self.invalidate_settings('timeconstant')
+
+    #Set time constant to the nearest (mode = 'nearest'), next longer
+    #(mode = 'ceil') or next shorter (mode = 'floor') value in seconds
+    def set_timeconstant_seconds(self, seconds, mode = 'nearest'):
+        self.set_timeconstant(int(timeconstant_index(seconds, mode)))
 
     #Get time constant
     def get_timeconstant(self):
-        val = None
-        rm = visa.ResourceManager()
-        if self.primary_id in rm.list_resources():
-            time_constant_map={
-                0 : '10us',
-                1 : '30us',
-                2 : '100us',
-                3 : '300us',
-                4 : '1ms',
-                5 : '3ms',
-                6 : '10ms',
-                7 : '30ms',
-                8 : '100ms',
-                9 : '300ms',
-                10 : '1s',
-                11 : '3s',
-                12 : '10s',
-                13 : '30s',
-                14 : '100s',
-                15 : '300s',
-                16 : '1ks',
-                17 : '3ks',
-                18 : '10ks',
-                19 : '30ks' }
-            inst = rm.open_resource(self.primary_id)
-            val = time_constant_map[int(inst.query('OFLT ?'))]
-            inst.close()
-        rm.close
-        return val
+        return time_constant_labels[self._get_setting('timeconstant')]
+
+    #Get time constant in seconds
+    def get_timeconstant_seconds(self):
+        return time_constants[self._get_setting('timeconstant')]
 
     #Set sensitivity
+    #value is the SENS index 0-26 or a label such as '10mV'
     def set_sensitivity(self, value = None):
-        rm = visa.ResourceManager()
-        if self.primary_id in rm.list_resources():
-            if value is None:
-                print('SELECT SENSITIVITY')
-                print('0  : 2nV        13 : 50uV')
-                print('1  : 5nV        14 : 100uV')
-                print('2  : 10nV       15 : 200uV')
-                print('3  : 20nV       16 : 500uV')
-                print('4  : 50nV       17 : 1mV')
-                print('5  : 100nV      18 : 2mV')
-                print('6  : 200nV      19 : 5mV')
-                print('7  : 500nV      20 : 10mV')
-                print('8  : 1uV        21 : 20mV')
-                print('9  : 2uV        22 : 50mV')
-                print('10 : 5uV        23 : 100mV')
-                print('11 : 10uV       24 : 200mV')
-                print('12 : 20uV       25 : 500mV')
-                print('                26 : 1V')
-                sens_set = ast.literal_eval(input())
+        if value is None:
+            print('SELECT SENSITIVITY')
+            print_table(sensitivity_labels)
+            value = ast.literal_eval(input())
+        sens_set = parse_table_index(value, sensitivity_labels)
+        if sens_set is None:
+            print("Invalid Input: Must be integer between 0 and 26")
+            return
+        self.write('SENS ' + str(sens_set))
+        self._settings['sensitivity'] = sens_set
+
+    #Set sensitivity to the nearest (mode = 'nearest'), next larger
+    #(mode = 'ceil') or next smaller (mode = 'floor') full scale in volts
+    def set_sensitivity_volts(self, volts, mode = 'nearest'):
+        self.set_sensitivity(int(sensitivity_index(volts, mode)))
+
+    #Set the smallest sensitivity that keeps amplitude (V) below
+    #headroom * full scale
+    def set_sensitivity_for_signal(self, amplitude, headroom = 1.0):
+        self.set_sensitivity(int(sensitivity_for_signal(amplitude, headroom)))
+
+    #Get sensitivity
+    def get_sensitivity(self):
+        return sensitivity_labels[self._get_setting('sensitivity')]
+
+    #Get sensitivity full scale in volts
+    def get_sensitivity_volts(self):
+        return sensitivities[self._get_setting('sensitivity')]
+
+    #Time (s) for the output to settle to 99% after a step, from the
+    #cached time constant and filter slope
+    def get_settling_time(self):
+        return settling_timeconstants[self._get_setting('slope')] * self.get_timeconstant_seconds()
+
+    #Software autorange for use during sweeps. Unlike AGAN, it only steps
+    #the sensitivity when R leaves the [lower, upper] window of full scale
+    #(or an overload is latched in LIAS?), jumps straight to the range that
+    #puts R at target * full scale, and waits only the settling time after
+    #a change. Costs two queries when no change is needed.
+    #Returns the sensitivity index.
+    def autorange(self, upper = 0.9, lower = 0.1, target = 0.5, max_steps = 10):
+        sens_index = self._get_setting('sensitivity')
+        for step in range(max_steps):
+            overload = int(self.read('LIAS ?')) & overload_mask
+            r = self.snap('R', 'THETA')[0]
+            full_scale = sensitivities[sens_index]
+            if overload or r > upper * full_scale:
+                new_index = max(sens_index + 1, int(sensitivity_for_signal(r, target)))
+            elif r < lower * full_scale:
+                new_index = int(sensitivity_for_signal(r, target))
             else:
-                try:
-                    sens_set = int(value)
-                except ValueError:
-                    print("ERROR: Not an integer")
-            if isinstance(sens_set,int) and (0 <= sens_set <= 26):
-                inst = rm.open_resource(self.primary_id)
-                inst.write('SENS ' + str(sens_set))
-                inst.close()
+                break
+            new_index = min(new_index, len(sensitivities) - 1)
+            if new_index == sens_index:
+                break
+            self.set_sensitivity(new_index)
+            sens_index = new_index
+            time.sleep(self.get_settling_time())
+            self.read('LIAS ?') # Clear overloads latched while switching
+        return sens_index
+
+    # Reads 2 to 6 parameters at the same instant with a single SNAP? query.
+    # Parameters may be names from snap_parameters (e.g. 'X', 'THETA')
+    # or the raw SR830 codes 1-11. Defaults to X and Y.
+    def snap(self, *params):
+        if len(params) == 0:
+            params = ('X', 'Y')
+        if not 2 <= len(params) <= 6:
+            print('ERROR: SNAP takes between 2 and 6 parameters.')
+            return
+        codes = []
+        for param in params:
+            if isinstance(param, str):
+                code = snap_parameters.get(param.upper())
+            elif isinstance(param, (int, long)):
+                code = param
             else:
-                print("Invalid Input: Must be integer between 0 and 26")
-        rm.close
+                code = None
+            if code not in snap_parameters.values():
+                print('ERROR: Unknown SNAP parameter ' + str(param))
+                return
+            codes.append(str(code))
+        answer = self.read('SNAP ? ' + ','.join(codes))
+        values = [float(value) for value in answer.split(',')]
+        if self.bus is not None:
+            now = time.time() # One instant for all of them
+            for code, value in zip(codes, values):
+                name = snap_names[int(code)]
+                self.bus.publish(self.bus_source, name, value, snap_units.get(name, ''), now)
+        return values
+
+    # Sets what CH1 or CH2 displays (and therefore what the data buffer stores)
+    # CH1: 'X', 'R', 'XN', 'AUX1', 'AUX2'
+    # CH2: 'Y', 'THETA', 'YN', 'AUX3', 'AUX4'
+    def set_display(self, channel, quantity):
+        if channel not in display_quantities:
+            print('ERROR: channel must be 1 or 2')
+            return
+        try:
+            code = display_quantities[channel].index(str(quantity).upper())
+        except ValueError:
+            print('ERROR: CH' + str(channel) + ' cannot display ' + str(quantity))
+            return
+        self.write('DDEF ' + str(channel) + ', ' + str(code) + ', 0')
 
-    #Get time constant
-    def get_sensitivity(self):
-        val = None
-        rm = visa.ResourceManager()
-        if self.primary_id in rm.list_resources():
-            sens_map={
-                0 : '2nV',
-                1 : '5nV',
-                2 : '10nV',
-                3 : '20nV',
-                4 : '50nV',
-                5 : '100nV',
-                6 : '200nV',
-                7 : '500nV',
-                8 : '1uV',
-                9 : '2uV',
-                10 : '5uV',
-                11 : '10uV',
-                12 : '20uV',
-                13 : '50uV',
-                14 : '100uV',
-                15 : '200uV',
-                16 : '500uV',
-                17 : '1mV',
-                18 : '2mV',
-                19 : '5mV',
-                20 : '10mV',
-                21 : '20mV',
-                22 : '50mV',
-                23 : '100mV',
-                24 : '200mV',
-                25 : '500mV',
-                26 : '1V' }
-            inst = rm.open_resource(self.primary_id)
-            val = sens_map[int(inst.query('SENS ?'))]
-            inst.close()
-        rm.close
-        return val
+    # Gets what CH1 or CH2 displays
+    def get_display(self, channel = 1):
+        if channel not in display_quantities:
+            print('ERROR: channel must be 1 or 2')
+            return
+        resp = self.read('DDEF ? ' + str(channel))
+        return display_quantities[channel][int(resp.split(',')[0])]
+
+    # Sets the data buffer sample rate to the nearest available rate
+    # (62.5 mHz to 512 Hz in powers of 2), or 'TRIGGER' for external trigger
+    def set_sample_rate(self, rate):
+        if isinstance(rate, str):
+            if rate.upper() == 'TRIGGER':
+                self.write('SRAT 14')
+            else:
+                print('ERROR: Sample rate must be a number or TRIGGER')
+            return
+        if not 0 < rate <= sample_rates[-1]:
+            print('ERROR: Sample rate out of bounds.')
+            return
+        index = int(np.argmin(np.abs(np.log2(sample_rates / rate))))
+        self.write('SRAT ' + str(index))
+
+    # Gets the data buffer sample rate in Hz
+    def get_sample_rate(self):
+        index = int(self.read('SRAT ?'))
+        if index == 14:
+            return 'TRIGGER'
+        return sample_rates[index]
+
+    # Clears the data buffer
+    def reset_buffer(self):
+        self.write('REST')
+
+    # Starts or resumes filling the data buffer
+    def start_buffer(self):
+        self.write('STRT')
+
+    # Pauses filling the data buffer
+    def pause_buffer(self):
+        self.write('PAUS')
+
+    # Number of points stored in the data buffer
+    def get_buffer_size(self):
+        return int(self.read('SPTS ?'))
+
+    # Reads points from the CH1 or CH2 data buffer into a numpy array.
+    # By default TRCB transfers IEEE floats. fast_format = True uses TRCL,
+    # the SR830's own 4 byte format (int16 mantissa, int16 exponent), which
+    # the instrument formats faster.
+    def read_buffer(self, channel = 1, start = 0, count = None, fast_format = False):
+        if channel not in display_quantities:
+            print('ERROR: channel must be 1 or 2')
+            return
+        if count is None:
+            count = self.get_buffer_size() - start
+        if count <= 0:
+            return np.zeros(0)
+        command = 'TRCL ? ' if fast_format else 'TRCB ? '
+        raw = self.read_binary(command + str(channel) + ', ' + str(start) + ', ' + str(count), 4 * count)
+        if fast_format:
+            words = np.frombuffer(raw, dtype = '<i2').reshape(-1, 2)
+            return words[:, 0] * 2.0 ** (words[:, 1] - 124)
+        return np.frombuffer(raw, dtype = '<f4').astype(float)
+
+    # Fills the data buffer with npoints at sample_rate (Hz or 'TRIGGER') and returns the
+    # stored channels as a numpy array with one row per channel.
+    # The time of point i is i / sample_rate after the start.
+    # Raises TimeoutError if the buffer is not full timeout seconds after it
+    # should have been (after the start for 'TRIGGER'); None waits forever.
+    def acquire_buffer(self, npoints, sample_rate = 512, channels = (1, 2), fast_format = False, timeout = 60):
+        if not 0 < npoints <= buffer_length:
+            print('ERROR: npoints must be between 1 and ' + str(buffer_length))
+            return
+        self.pause_buffer()
+        self.reset_buffer()
+        self.set_sample_rate(sample_rate)
+        self.write('SEND 0') # One shot: stop when the buffer is full
+        rate = self.get_sample_rate()
+        poll_time = 0.1
+        self.start_buffer()
+        if rate != 'TRIGGER':
+            time.sleep(npoints / rate)
+            poll_time = min(poll_time, 10.0 / rate)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            size = self.get_buffer_size()
+            if size >= npoints:
+                break
+            if (deadline is not None) and (time.time() > deadline):
+                self.pause_buffer()
+                raise TimeoutError('SR830 buffer has ' + str(size) + ' of ' + str(npoints) + ' points after ' + str(timeout) + ' s')
+            time.sleep(poll_time)
+        self.pause_buffer()
+        return np.vstack([self.read_buffer(channel, 0, npoints, fast_format) for channel in channels])
 
     def set_input_A(self):
         self.write('ISRC 0')
+        self._settings['input'] = 0
 
     def set_input_AminusB(self):
         self.write('ISRC 1')
+        self._settings['input'] = 1
 
     def get_input_setting(self): # A or A-B?
-        answer = self.read('ISRC ?')
-        if answer == '0\n':
+        answer = self._get_setting('input')
+        if answer == 0:
             return 'A'
-        elif answer == '1\n':
+        elif answer == 1:
             return 'A-B'
         else:
             return 'unknown state'
@@ -308,6 +614,12 @@ class lockin:
 
     # TO DO: Eliminate code duplication
     def loop(self):
+        # Bare words such as X or THETA are passed through as strings
+        def parse_value(value):
+            try:
+                return ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                return value
         host = '127.0.0.1'
         port = 65426
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -323,11 +635,15 @@ class lockin:
             else:
                 try:
                     listen_commands = listen_string.split()
-                    listenArgs = [ast.literal_eval(argument) for argument in listen_commands[1:]]
+                    listenArgs = [parse_value(argument) for argument in listen_commands[1:]]
                     if listen_commands[0] in dir(self)[3:]:
                         try:
                             result = getattr(self, listen_commands[0])(*listenArgs)
-                            if result is not None:
+                            if isinstance(result, (list, tuple)):
+                                # e.g. 'snap X Y' replies '1.2e-06,3.4e-07'
+                                send_string = ','.join(str(value) for value in result) + '\n'
+                                conn.sendall(send_string.encode())
+                            elif result is not None:
                                 send_string = str(result) + '\n'
                                 conn.sendall(send_string.encode())
                             else:
@@ -18,6 +18,23 @@ dt_expression = r'^\s*((?P<days>[+-]?(\d*\.)?\d+)\s?d(ay)?s?)?\s*((?P<hours>[+-]
 dt_pattern = re.compile(dt_expression, re.IGNORECASE)
 now_pattern = re.compile(r'^\s*now\s*(?P<op>(\+|-))?\s*(?P<dt>([^\W_]|\s)+)?$', re.IGNORECASE)
 
+# What each monitor function reads, as published to the data bus:
+# function name : (attribute, unit)
+bus_quantities = {
+    '_onek_pot_temp' : ('onek_pot_temp', 'K'),
+    '_sorb_temp' : ('sorb_temp', 'K'),
+    '_needle_valve_temp' : ('needle_valve_temp', 'K'),
+    '_still_temp' : ('still_temp', 'K'),
+    '_cold_plate_temp' : ('cold_plate_temp', 'K'),
+    '_mix_chamber_temp' : ('mix_chamber_temp', 'K'),
+    '_stm_rx_temp' : ('stm_rx_temp', 'K'),
+    '_stm_cx_temp' : ('stm_cx_temp', 'K'),
+    '_tank_press' : ('tank_pressure', 'mbar'),
+    '_condense_press' : ('condense_pressure', 'mbar'),
+    '_still_press' : ('still_pressure', 'mbar'),
+    '_turbo_back_press' : ('turbo_back_pressure', 'mbar'),
+    '_n2_trap_press' : ('n2_trap_pressure', 'mbar') }
+
 # This class is not a Singleton, so multiple instances check temperature and pressure independently.
 class triton_monitor:
     """
@@ -28,10 +45,12 @@ class triton_monitor:
 
     """
     
-    def __init__(self, IP_address, port):
+    def __init__(self, IP_address, port, bus = None):
 
         self.IP_address = IP_address
         self.port = port
+        self.bus = bus # Optional data_bus.dataBus; every reading of the loop is published to it
+        self.bus_source = 'triton'
         self.function_array = [
             self._onek_pot_temp,
             self._sorb_temp,
@@ -103,6 +122,9 @@ class triton_monitor:
             try:
                 for func in self.function_array:
                     func()
+                    if self.bus is not None:
+                        attribute, unit = bus_quantities[func.__name__]
+                        self.bus.publish(self.bus_source, attribute, getattr(self, attribute), unit)
                     if self.terminate == 1:
                         break
                     time.sleep(0.25)